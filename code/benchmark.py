@@ -0,0 +1,197 @@
+# Micro-benchmarks of the perception hot path on the recorded test_dataset frames
+# Record a baseline with:
+#   $ python benchmark.py --save benchmark_baseline.json
+# and check a change against it with:
+#   $ python benchmark.py --baseline benchmark_baseline.json
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from perception import color_thresh, find_rocks, perspect_transform, rover_coords, \
+    to_polar_coords, pix_to_world, perception_step, CALIBRATION_SOURCE, calibration_destination
+from decision import decision_step
+from rover_state import RoverState
+from rover_clock import LoggedClock
+from replay import read_frames, load_frame, stop_timers
+from supporting_functions import create_output_images
+
+# Untimed calls of every stage before measuring
+WARMUP_FRAMES = 5
+# Differences below these are noise and never count as a regression
+MIN_TIME_DELTA_MS = 0.02
+MIN_ALLOC_DELTA_KB = 1.0
+
+# Define a function to load the benchmark frames with the intermediate
+# results the individual perception functions take as input
+def load_frames(log_path, count):
+    frames = []
+    for telemetry, image, timestamp in read_frames(log_path, stop=count):
+        image = np.ascontiguousarray(image)
+        warped, _ = perspect_transform(image, CALIBRATION_SOURCE, calibration_destination(image.shape))
+        navigable, _ = color_thresh(warped)
+        xpix, ypix = rover_coords(navigable)
+        frames.append({'telemetry': telemetry, 'image': image, 'timestamp': timestamp,
+                       'warped': warped, 'xpix': xpix, 'ypix': ypix})
+    return frames
+
+class RoverStage(object):
+    """
+    Benchmark stage that needs a Rover loaded with the frame. The frame is
+    loaded and, for stages after perception, perceived outside the timed
+    call, so the Rover evolves the way it does in replay.
+    """
+
+    def __init__(self, func, perceive_first):
+        self.func = func
+        self.perceive_first = perceive_first
+        self.Rover = None
+
+    def reset(self):
+        self.close()
+        self.Rover = RoverState(LoggedClock())
+
+    def setup(self, frame):
+        load_frame(self.Rover, frame['telemetry'], frame['image'], frame['timestamp'])
+        self.Rover.timers.tick(self.Rover.total_time)
+        if self.perceive_first:
+            perception_step(self.Rover)
+        return (self.Rover,)
+
+    def close(self):
+        if self.Rover is not None:
+            stop_timers(self.Rover)
+            self.Rover = None
+
+# Define a function to build the benchmark stages as (name, setup, call,
+# rover stage) where setup(frame) returns the arguments of the timed call
+def benchmark_stages():
+    world_size = 200
+    scale = 10
+    dst = calibration_destination((160, 320, 3))
+    stages = [
+        ('color_thresh', lambda frame: (frame['warped'],), color_thresh),
+        ('find_rocks', lambda frame: (frame['image'],), find_rocks),
+        ('perspect_transform', lambda frame: (frame['image'], CALIBRATION_SOURCE, dst), perspect_transform),
+        ('rover_coords', lambda frame: (color_thresh(frame['warped'])[0],), rover_coords),
+        ('to_polar_coords', lambda frame: (frame['xpix'], frame['ypix']), to_polar_coords),
+        ('pix_to_world', lambda frame: (frame['xpix'], frame['ypix'],
+                                        frame['telemetry']['X_Position'], frame['telemetry']['Y_Position'],
+                                        frame['telemetry']['Yaw'], world_size, scale), pix_to_world),
+    ]
+    stages = [(name, setup, call, None) for name, setup, call in stages]
+    for name, func, perceive_first in (('perception_step', perception_step, False),
+                                       ('decision_step', decision_step, True),
+                                       ('create_output_images', create_output_images, True)):
+        rover_stage = RoverStage(func, perceive_first)
+        stages.append((name, rover_stage.setup, func, rover_stage))
+    return stages
+
+# Define a function to time one stage over all frames, returning the
+# per-call times in ms, one row per pass, and the peak bytes allocated by
+# each call
+def run_stage(stage, frames, repeat):
+    _, setup, call, rover_stage = stage
+    times = [[] for _ in range(repeat)]
+    allocs = []
+    try:
+        for attempt in range(repeat + 1):
+            if rover_stage is not None:
+                rover_stage.reset()
+            # The first pass warms up caches, the last one measures allocations
+            for idx, frame in enumerate(frames):
+                args = setup(frame)
+                if attempt == 0:
+                    if idx < WARMUP_FRAMES:
+                        call(*args)
+                    continue
+                start = time.perf_counter()
+                call(*args)
+                times[attempt - 1].append(1000 * (time.perf_counter() - start))
+        if rover_stage is not None:
+            rover_stage.reset()
+        tracemalloc.start()
+        for frame in frames:
+            args = setup(frame)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            call(*args)
+            allocs.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+    finally:
+        if rover_stage is not None:
+            rover_stage.close()
+    return np.array(times), np.array(allocs)
+
+# Define a function to run the benchmark and return the results as a dict
+def run_benchmark(log_path, count=50, repeat=5, names=None):
+    frames = load_frames(log_path, count)
+    results = {'meta': {'log': log_path, 'frames': len(frames), 'repeat': repeat,
+                        'python': platform.python_version(), 'numpy': np.__version__,
+                        'opencv': cv2.__version__, 'machine': platform.machine()},
+               'stages': {}}
+    for stage in benchmark_stages():
+        if names and stage[0] not in names:
+            continue
+        times, allocs = run_stage(stage, frames, repeat)
+        # The best pass median is far less sensitive to other load on
+        # the machine than the median of all calls
+        results['stages'][stage[0]] = {'median_ms': float(np.median(times, axis=1).min()),
+                                       'p99_ms': float(np.percentile(times, 99)),
+                                       'alloc_kb': float(np.median(allocs)) / 1024}
+    return results
+
+# Define a function to compare results with a baseline, returning the report
+# lines and the names of the stages that regressed past the threshold
+def compare_results(results, baseline, threshold=0.2, alloc_threshold=0.1):
+    lines = ['{:<22}{:>11}{:>11}{:>12}{:>9}'.format('stage', 'median ms', 'p99 ms', 'alloc KB', 'ratio')]
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline.get('stages', {}).get(name) if baseline else None
+        ratio = ''
+        status = ''
+        if base:
+            ratio = '{:.2f}'.format(stage['median_ms'] / base['median_ms']) if base['median_ms'] > 0 else ''
+            slower = stage['median_ms'] > base['median_ms'] * (1 + threshold) and \
+                stage['median_ms'] - base['median_ms'] > MIN_TIME_DELTA_MS
+            bigger = stage['alloc_kb'] > base['alloc_kb'] * (1 + alloc_threshold) and \
+                stage['alloc_kb'] - base['alloc_kb'] > MIN_ALLOC_DELTA_KB
+            if slower or bigger:
+                regressions.append(name)
+                status = '  REGRESSED ({})'.format(', '.join(
+                    label for label, flag in (('time', slower), ('allocations', bigger)) if flag))
+        lines.append('{:<22}{:>11.3f}{:>11.3f}{:>12.1f}{:>9}{}'.format(
+            name, stage['median_ms'], stage['p99_ms'], stage['alloc_kb'], ratio, status))
+    return lines, regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Perception micro-benchmarks')
+    parser.add_argument('--log', type=str, default='../test_dataset/robot_log.csv',
+                        help='Recording to take the frames from, a robot_log.csv or frame log.')
+    parser.add_argument('--frames', type=int, default=50, help='Number of frames to benchmark on.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed passes over the frames.')
+    parser.add_argument('--stages', type=str, nargs='*', default=None, help='Only run these stages.')
+    parser.add_argument('--save', type=str, default='', help='Save the results as a JSON baseline to this path.')
+    parser.add_argument('--baseline', type=str, default='', help='Compare against the JSON baseline at this path.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fail when a median latency grows by more than this fraction.')
+    parser.add_argument('--alloc-threshold', type=float, default=0.1,
+                        help='Fail when allocations grow by more than this fraction.')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.log, args.frames, args.repeat, args.stages)
+    baseline = None
+    if args.baseline != '':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    lines, regressions = compare_results(results, baseline, args.threshold, args.alloc_threshold)
+    print('\n'.join(lines))
+    if args.save != '':
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+    if regressions:
+        print('Regressed: {}'.format(', '.join(regressions)))
+        sys.exit(1)
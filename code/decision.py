@@ -1,7 +1,10 @@
 
 import numpy as np
-import time
-from state import Stop, Search, Breakout
+from state import Stop, Search
+from event_log import get_logger
+
+# Logs timer and sample search events, rate limited per message
+logger = get_logger('rover.decision')
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
@@ -11,33 +14,37 @@ def decision_step(Rover):
     # improve on this decision tree to do a good job of navigating autonomously!
     Rover.prev_steer = Rover.steer
 
+    # Let the exploration planner update the target heading within its budget
+    if Rover.planner is not None:
+        Rover.planner.step(Rover)
+
     if Rover.located_rock and not Rover.cancel_search.running:
-        print("Looking for samples...")
-        Rover.mode = Search()
+        logger.info('sample_search start=True')
+        Rover.states.transition(Search)
         Rover.cancel_search.start()
 
-    if Rover.vel < 0.3 and len(Rover.nav_angles) > Rover.go_forward:
+    if Rover.vel < 0.3 and Rover.nav_count > Rover.go_forward:
         if not Rover.stop_breakout.running and \
         not Rover.cancel_search.running and \
         not Rover.cancel_loop.running:
-            print("Starting breakout timer...")
+            logger.info('timer_start timer=breakout')
             Rover.stop_breakout.start()
         elif Rover.stop_breakout.running and \
         Rover.cancel_search.running:
-            print("Stoping breakout timer...")
+            logger.info('timer_stop timer=breakout')
             Rover.stop_breakout.stop()
     elif Rover.stop_breakout.running:
-        print("Stoping breakout timer...")
+        logger.info('timer_stop timer=breakout')
         Rover.stop_breakout.stop()
 
     if (Rover.vel == Rover.max_vel and Rover.steer == Rover.prev_steer):
             if not Rover.stop_breakout.running and \
             not Rover.cancel_search.running and \
             not Rover.cancel_loop.running:
-                print("starting loop timer...")
+                logger.info('timer_start timer=loop')
                 Rover.cancel_loop.start()
     elif Rover.cancel_loop.running:
-        print("stoping loop timer...")
+        logger.info('timer_stop timer=loop')
         Rover.cancel_loop.stop()
 
     Rover.mode.evaluate(Rover)
@@ -46,8 +53,10 @@ def decision_step(Rover):
     if Rover.near_sample and Rover.vel == 0 and not Rover.picking_up:
         Rover.send_pickup = True
         Rover.located_rock = False
+        Rover.rock_tracker.mark_collected(Rover.pos[0], Rover.pos[1])
+        Rover.rock_target = None
         Rover.cancel_search.stop()
-        Rover.mode = Stop()
+        Rover.states.transition(Stop)
 
     return Rover
 
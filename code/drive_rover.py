@@ -1,94 +1,36 @@
 # Do the necessary imports
 import argparse
+import atexit
+import logging
 import shutil
 import base64
-from datetime import datetime
 import os
 import cv2
 import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
+from eventlet import tpool
 from PIL import Image
-from flask import Flask
+from flask import Flask, jsonify
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
-from threading import Timer
 # Import functions for perception and decision making
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
-from rover_timer import CancelSearch, StopBreakout, CancelLoop
-from state import Stop
+from supporting_functions import update_rover, OutputSnapshot, InsetScheduler
+from rover_state import RoverState, configure_rover
+from recorder import FrameRecorder
+from frame_timing import FrameTimer
+from steering import STEERING_POLICIES
+from mapping import MAP_FUSIONS
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.prev_pos = None
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = Stop() # Current mode (can be forward or stop)
-        self.throttle_set = 0.2 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 50 # Threshold to initiate stopping
-        self.go_forward = 200 # Threshold to go forward again
-        self.max_vel = 1.5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.worldmap_filter = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        self.located_rock = False
-        self.rock_angle = 0
-        self.rock_dist = 0
-        self.rock_pos = 0
-        self.cancel_search = CancelSearch([self])
-        self.stop_breakout = StopBreakout([self])
-        self.cancel_loop = CancelLoop([self])
-
 # Initialize our rover 
 Rover = RoverState()
 
@@ -99,6 +41,38 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+# Records frames in image_folder mode, created at startup
+recorder = None
+
+# Per-frame stage timings, replaced with the command line settings at startup
+frame_timer = FrameTimer()
+
+# Throttles the inset images and caches their encoded strings,
+# replaced with the --display-rate setting at startup
+inset_scheduler = InsetScheduler()
+
+# Variables for pipelined mode
+# Green thread rendering the next inset images
+render_job = None
+
+# Define a function to render inset images on the worker thread pool
+def render_insets(snapshot, key, now):
+    return tpool.execute(inset_scheduler.images, snapshot, now, key)
+
+# Define a function to return the most recent inset images and start
+# rendering the current state if a render is due and none is running
+def pipelined_insets(Rover):
+    global render_job
+    if render_job is not None and render_job.dead:
+        render_job.wait()
+        render_job = None
+    now = time.time()
+    if render_job is None and inset_scheduler.due(now):
+        # Render from a copy since the Rover changes while the worker runs
+        render_job = eventlet.spawn(render_insets, OutputSnapshot(Rover),
+                                    inset_scheduler.state_key(Rover), now)
+    return inset_scheduler.map_string, inset_scheduler.vision_string
+
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
@@ -115,17 +89,42 @@ def telemetry(sid, data):
 
     if data:
         global Rover
+        frame_timer.start_frame()
         # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        if args.pipeline:
+            # Decode on the worker thread pool, overlapping with the render
+            # of the previous frame's inset images
+            Rover, image = tpool.execute(update_rover, Rover, data)
+        else:
+            Rover, image = update_rover(Rover, data)
+        # Fire any rover timers that are due on this frame's clock
+        Rover.timers.tick(Rover.total_time)
+        frame_timer.mark('update')
+
+        # If you want to save camera images from autonomous driving specify a path
+        # Example: $ python drive_rover.py image_folder_path
+        # Queue the received frame and telemetry if a folder was specified,
+        # the recorder writes them on its own thread
+        if recorder is not None:
+            recorder.record(image, Rover)
+            frame_timer.skip()
 
         if np.isfinite(Rover.vel):
 
             # Execute the perception and decision steps to update the Rover's state
             Rover = perception_step(Rover)
+            frame_timer.mark('perception')
             Rover = decision_step(Rover)
+            frame_timer.mark('decision')
 
             # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+            if args.pipeline:
+                # Send the commands right away with the latest finished inset
+                # images, the current ones are rendered in the background
+                out_image_string1, out_image_string2 = pipelined_insets(Rover)
+            else:
+                out_image_string1, out_image_string2 = inset_scheduler.images(Rover)
+            frame_timer.mark('insets')
 
             # The action step!  Send commands to the rover!
  
@@ -148,14 +147,8 @@ def telemetry(sid, data):
 
             # Send zeros for throttle, brake and steer and empty images
             send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        frame_timer.mark('emit')
+        frame_timer.end_frame()
 
     else:
         sio.emit('manual', data={}, skip_sid=True)
@@ -185,6 +178,23 @@ def send_control(commands, image_string1, image_string2):
         data,
         skip_sid=True)
     eventlet.sleep(0)
+# Define a function to flush the recording when the server exits
+def close_recorder():
+    recorder.close()
+    print("Recorder: {}".format(recorder.stats()))
+
+# Define a function to report the stage timings when the server exits
+def close_frame_timer():
+    frame_timer.close()
+    print(frame_timer.report())
+    if args.timings != '':
+        frame_timer.export(args.timings)
+
+# Serve the stage timing summary of the recent frames as JSON
+@app.route('/timings')
+def timing_summary():
+    return jsonify(frame_timer.summary())
+
 # Define a function to send the "pickup" command 
 def send_pickup():
     #print("Picking up")
@@ -203,7 +213,57 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Decode telemetry and render inset images on a worker thread pool so commands are sent without waiting for the insets.'
+    )
+    parser.add_argument(
+        '--display-rate',
+        type=float,
+        default=5,
+        help='Target refresh rate of the inset images in Hz, 0 renders them on every frame.'
+    )
+    parser.add_argument(
+        '--timings',
+        type=str,
+        default='',
+        help='Save the stage timings on exit, a .json path saves the percentile summary and any other path the per-frame timings as csv.'
+    )
+    parser.add_argument(
+        '--slow-frame',
+        type=float,
+        default=0,
+        help='Frames taking longer than this many ms count as slow, 0 disables slow frame tracking.'
+    )
+    parser.add_argument(
+        '--profile-after',
+        type=int,
+        default=0,
+        help='Profile the next frames with cProfile after this many consecutive slow frames, 0 disables profiling.'
+    )
+    parser.add_argument(
+        '--steering',
+        type=str,
+        default='mean',
+        choices=STEERING_POLICIES,
+        help='Steering policy used when driving forward.'
+    )
+    parser.add_argument(
+        '--mapping',
+        type=str,
+        default='count',
+        choices=MAP_FUSIONS,
+        help='Map fusion: frame counts of level frames or distance and tilt weighted log-odds.'
+    )
     args = parser.parse_args()
+    configure_rover(Rover, args.steering, args.mapping)
+    # State transitions and timer events are logged rate limited
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    inset_scheduler = InsetScheduler(args.display_rate)
+    frame_timer = FrameTimer(slow_frame=args.slow_frame / 1000 if args.slow_frame > 0 else None,
+                             profile_after=args.profile_after)
+    atexit.register(close_frame_timer)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -214,6 +274,8 @@ if __name__ == '__main__':
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
         #print("Recording this run ...")
+        recorder = FrameRecorder(args.image_folder)
+        atexit.register(close_recorder)
     else:
         pass
         #print("NOT recording this run ...")
@@ -0,0 +1,47 @@
+import logging
+import time
+
+# Messages a logger passes per RATE_PERIOD before further ones are dropped
+RATE_BURST = 10
+# Seconds over which RATE_BURST messages are allowed
+RATE_PERIOD = 1.0
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per message template, so a message logged on every frame
+    costs at most burst writes per period. The next message that passes
+    carries the number dropped since in its suppressed attribute and
+    message.
+    """
+
+    def __init__(self, burst=RATE_BURST, period=RATE_PERIOD):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.period = period
+        self.buckets = {} # Template -> [tokens, last refill, suppressed]
+
+    def filter(self, record):
+        now = time.monotonic()
+        bucket = self.buckets.get(record.msg)
+        if bucket is None:
+            bucket = self.buckets[record.msg] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.burst / self.period)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        record.suppressed = bucket[2]
+        if bucket[2]:
+            record.msg = record.msg + ' suppressed=%d'
+            record.args = tuple(record.args) + (bucket[2],)
+            bucket[2] = 0
+        return True
+
+# Define a function to return a rate limited logger, messages are
+# key=value pairs so they can be parsed from the log
+def get_logger(name, burst=RATE_BURST, period=RATE_PERIOD):
+    logger = logging.getLogger(name)
+    if not any(isinstance(existing, RateLimitFilter) for existing in logger.filters):
+        logger.addFilter(RateLimitFilter(burst, period))
+    return logger
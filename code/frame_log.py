@@ -0,0 +1,186 @@
+# Compact append-only recording format for replay
+# Convert a test_dataset style recording with:
+#   $ python frame_log.py to-log ../test_dataset/robot_log.csv test_dataset.rlog
+# and back with:
+#   $ python frame_log.py to-csv test_dataset.rlog test_dataset_copy
+import argparse
+import json
+import os
+from datetime import datetime
+import cv2
+import numpy as np
+
+# First bytes of every frame log
+MAGIC = b'ROVERLOG'
+# Bytes reserved for the magic and the JSON header, records follow
+HEADER_SIZE = 4096
+# Records are padded to this many bytes so frames stay aligned
+RECORD_ALIGN = 64
+# Telemetry columns stored with every frame, as in robot_log.csv
+TELEMETRY_COLUMNS = ('SteerAngle', 'Throttle', 'Brake', 'Speed',
+                     'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll')
+# Camera frame shape
+FRAME_SHAPE = (160, 320, 3)
+
+# Define a function to build the record dtype of a frame log
+def record_dtype(shape, columns):
+    fields = [('frame', np.uint8, tuple(shape)),
+              ('timestamp', '<f8'),
+              ('telemetry', '<f8', (len(columns),))]
+    size = np.dtype(fields).itemsize
+    padding = -size % RECORD_ALIGN
+    if padding:
+        fields.append(('padding', np.uint8, (padding,)))
+    return np.dtype(fields)
+
+# Define a function to check whether a file is a frame log
+def is_frame_log(path):
+    try:
+        with open(path, 'rb') as log_file:
+            return log_file.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+# Define a function to read the header of a frame log
+def read_header(log_file):
+    block = log_file.read(HEADER_SIZE)
+    if len(block) < HEADER_SIZE or not block.startswith(MAGIC):
+        raise ValueError('Not a frame log')
+    return json.loads(block[len(MAGIC):].rstrip(b'\0').decode('utf-8'))
+
+class FrameLog(object):
+    """
+    Read side of a frame log. Frames, timestamps and telemetry are views
+    into a read-only np.memmap of the file, so replay reads frames
+    without copying or decoding them. A partially written last record is
+    ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as log_file:
+            header = read_header(log_file)
+        self.shape = tuple(header['shape'])
+        self.columns = tuple(header['columns'])
+        self.dtype = record_dtype(self.shape, self.columns)
+        count = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode='r',
+                                     offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+        self.frames = self.records['frame']
+        self.timestamps = self.records['timestamp']
+        self.telemetry = self.records['telemetry']
+        self.column_index = dict((name, idx) for idx, name in enumerate(self.columns))
+
+    def __repr__(self):
+        return '{}({}, {} frames)'.format(self.__class__.__name__, self.path, len(self))
+
+    def __len__(self):
+        return len(self.records)
+
+    def telemetry_dict(self, idx):
+        """
+        Return the telemetry of one frame as a dict of floats.
+        """
+        return dict(zip(self.columns, self.telemetry[idx].tolist()))
+
+class FrameLogWriter(object):
+    """
+    Append side of a frame log. Frames are stored raw so they can be
+    memory mapped on replay. Appending to an existing log first drops any
+    partially written record.
+    """
+
+    def __init__(self, path, shape=FRAME_SHAPE, columns=TELEMETRY_COLUMNS):
+        self.path = path
+        self.shape = tuple(shape)
+        self.columns = tuple(columns)
+        self.dtype = record_dtype(self.shape, self.columns)
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as log_file:
+                header = read_header(log_file)
+            if tuple(header['shape']) != self.shape or tuple(header['columns']) != self.columns:
+                raise ValueError('Frame log {} has a different layout'.format(path))
+            count = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+            self.log_file = open(path, 'r+b')
+            self.log_file.truncate(HEADER_SIZE + count * self.dtype.itemsize)
+            self.log_file.seek(0, os.SEEK_END)
+        else:
+            header = json.dumps({'version': 1, 'shape': list(self.shape),
+                                 'columns': list(self.columns)}).encode('utf-8')
+            if len(MAGIC) + len(header) > HEADER_SIZE:
+                raise ValueError('Frame log header too large')
+            self.log_file = open(path, 'wb')
+            self.log_file.write((MAGIC + header).ljust(HEADER_SIZE, b'\0'))
+        self.record = np.zeros(1, dtype=self.dtype)
+
+    def append(self, frame, telemetry, timestamp=None):
+        """
+        Append one RGB frame with its telemetry, given as a sequence in
+        column order or a dict keyed by column name.
+        """
+        if isinstance(telemetry, dict):
+            telemetry = [telemetry[name] for name in self.columns]
+        self.record['frame'] = frame
+        self.record['timestamp'] = np.nan if timestamp is None else timestamp
+        self.record['telemetry'] = telemetry
+        self.log_file.write(self.record.tobytes())
+
+    def close(self):
+        self.log_file.close()
+
+# Define a function to convert an IMG folder and robot_log.csv to a frame log
+def convert_from_csv(csv_path, log_path):
+    # Imported here since replay imports this module
+    from replay import read_frames
+    writer = FrameLogWriter(log_path)
+    count = 0
+    try:
+        for telemetry, image, timestamp in read_frames(csv_path):
+            writer.append(image, telemetry, timestamp)
+            count += 1
+    finally:
+        writer.close()
+    return count
+
+# Define a function to convert a frame log back to an IMG folder and
+# robot_log.csv, the JPEGs are written at maximum quality
+def convert_to_csv(log_path, folder):
+    log = FrameLog(log_path)
+    image_folder = os.path.join(folder, 'IMG')
+    if not os.path.exists(image_folder):
+        os.makedirs(image_folder)
+    with open(os.path.join(folder, 'robot_log.csv'), 'w') as csv_file:
+        csv_file.write(';'.join(('Path',) + log.columns) + '\n')
+        for idx in range(len(log)):
+            timestamp = log.timestamps[idx]
+            if np.isfinite(timestamp):
+                stamp = datetime.fromtimestamp(round(float(timestamp), 3))
+                name = 'robocam_{}.jpg'.format(stamp.strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3])
+            else:
+                name = 'frame_{:06d}.jpg'.format(idx)
+            path = os.path.join(image_folder, name)
+            cv2.imwrite(path, cv2.cvtColor(log.frames[idx], cv2.COLOR_RGB2BGR),
+                        [cv2.IMWRITE_JPEG_QUALITY, 100])
+            csv_file.write(';'.join([path] + [str(value) for value in log.telemetry[idx].tolist()]) + '\n')
+    return len(log)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert recordings to and from the frame log format')
+    subparsers = parser.add_subparsers(dest='command')
+    to_log = subparsers.add_parser('to-log', help='Convert a robot_log.csv and IMG folder to a frame log.')
+    to_log.add_argument('csv', type=str, help='Path to the robot_log.csv.')
+    to_log.add_argument('log', type=str, help='Path of the frame log to write.')
+    to_csv = subparsers.add_parser('to-csv', help='Convert a frame log to a robot_log.csv and IMG folder.')
+    to_csv.add_argument('log', type=str, help='Path to the frame log.')
+    to_csv.add_argument('folder', type=str, help='Folder to write robot_log.csv and IMG to.')
+    args = parser.parse_args()
+
+    if args.command == 'to-log':
+        print('Converted {} frames'.format(convert_from_csv(args.csv, args.log)))
+    elif args.command == 'to-csv':
+        print('Converted {} frames'.format(convert_to_csv(args.log, args.folder)))
+    else:
+        parser.print_help()
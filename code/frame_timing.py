@@ -0,0 +1,149 @@
+import cProfile
+import json
+import time
+import numpy as np
+
+# Stages of a telemetry frame, in the order they run
+TIMING_STAGES = ('update', 'perception', 'decision', 'insets', 'emit')
+# Percentiles reported for every stage
+TIMING_PERCENTILES = (50, 90, 99)
+
+class FrameTimer(object):
+    """
+    Per-frame stage timings kept in a fixed size ring buffer.
+
+    The telemetry handler calls start_frame(), mark() after every stage and
+    end_frame(). Each frame writes one preallocated row, so timing a frame
+    allocates nothing. Only the handler writes to the buffer, and readers
+    take a copy of it, so no lock is needed. Stages a frame skipped stay
+    NaN. When slow_frame is set and profile_after consecutive frames exceed
+    it, the next profile_frames frames are profiled with cProfile and the
+    stats are written to profile_prefix_<n>.prof.
+    """
+
+    def __init__(self, capacity=1024, stages=TIMING_STAGES, slow_frame=None,
+                 profile_after=0, profile_frames=100, profile_prefix='frame_profile'):
+        self.stages = tuple(stages)
+        self.columns = self.stages + ('frame',)
+        self.column_index = dict((stage, idx) for idx, stage in enumerate(self.columns))
+        self.capacity = capacity
+        self.buffer = np.full((capacity, len(self.columns)), np.nan)
+        self.count = 0 # Frames recorded since the start
+        self.slow_frame = slow_frame # Seconds
+        self.slow_frames = 0 # Frames slower than slow_frame since the start
+        self.slow_streak = 0 # Consecutive frames slower than slow_frame
+        self.profile_after = profile_after
+        self.profile_frames = profile_frames
+        self.profile_prefix = profile_prefix
+        self.profiles = [] # Paths of the profiles written so far
+        self.profiler = None
+        self.profiled = 0 # Frames profiled by the running profiler
+        self.row = None
+        self.frame_start = None
+        self.last_mark = None
+
+    def start_frame(self):
+        self.row = self.buffer[self.count % self.capacity]
+        self.row.fill(np.nan)
+        self.frame_start = self.last_mark = time.perf_counter()
+
+    def mark(self, stage):
+        """
+        Record the time since the previous mark as the time of stage.
+        """
+        now = time.perf_counter()
+        self.row[self.column_index[stage]] = now - self.last_mark
+        self.last_mark = now
+
+    def skip(self):
+        """
+        Restart the stage clock without recording a stage.
+        """
+        self.last_mark = time.perf_counter()
+
+    def end_frame(self):
+        frame_time = time.perf_counter() - self.frame_start
+        self.row[-1] = frame_time
+        self.count += 1
+        if self.slow_frame is None:
+            return
+        if frame_time > self.slow_frame:
+            self.slow_frames += 1
+            self.slow_streak += 1
+        else:
+            self.slow_streak = 0
+        if self.profiler is not None:
+            self.profiled += 1
+            if self.profiled >= self.profile_frames:
+                self._stop_profile()
+        elif self.profile_after and self.slow_streak >= self.profile_after:
+            self.slow_streak = 0
+            self.profiled = 0
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def _stop_profile(self):
+        self.profiler.disable()
+        path = '{}_{}.prof'.format(self.profile_prefix, len(self.profiles))
+        self.profiler.dump_stats(path)
+        self.profiles.append(path)
+        self.profiler = None
+        print("Profiled {} slow frames to {}".format(self.profiled, path))
+
+    def timings(self):
+        """
+        Return a copy of the buffered timings in ms, oldest frame first.
+        """
+        if self.count <= self.capacity:
+            rows = self.buffer[:self.count]
+        else:
+            split = self.count % self.capacity
+            rows = np.concatenate((self.buffer[split:], self.buffer[:split]))
+        return 1000 * rows
+
+    def summary(self):
+        """
+        Return the percentiles and maximum in ms of every stage over the
+        buffered frames.
+        """
+        timings = self.timings()
+        result = {'frames': self.count, 'buffered': len(timings), 'slow_frames': self.slow_frames,
+                  'profiles': list(self.profiles), 'stages': {}}
+        for stage, column in zip(self.columns, timings.T):
+            column = column[np.isfinite(column)]
+            if len(column) == 0:
+                continue
+            stats = dict(('p{}'.format(percentile), float(value)) for percentile, value
+                         in zip(TIMING_PERCENTILES, np.percentile(column, TIMING_PERCENTILES)))
+            stats['max'] = float(column.max())
+            stats['count'] = len(column)
+            result['stages'][stage] = stats
+        return result
+
+    def report(self):
+        """
+        Return the summary as printable lines.
+        """
+        summary = self.summary()
+        lines = ['Frames: {} ({} slow)'.format(summary['frames'], summary['slow_frames'])]
+        for stage, stats in summary['stages'].items():
+            lines.append('{:<11}'.format(stage) + '  '.join(
+                '{} {:7.2f} ms'.format(name, stats[name])
+                for name in ['p{}'.format(percentile) for percentile in TIMING_PERCENTILES] + ['max']))
+        return '\n'.join(lines)
+
+    def export(self, path):
+        """
+        Write the summary to a .json path, or the buffered per-frame
+        timings in ms to any other path as csv.
+        """
+        if path.endswith('.json'):
+            with open(path, 'w') as export_file:
+                json.dump(self.summary(), export_file, indent=2)
+        else:
+            np.savetxt(path, self.timings(), fmt='%.3f', delimiter=';',
+                       header=';'.join(self.columns), comments='')
+
+    def close(self):
+        if self.profiler is not None:
+            self._stop_profile()
@@ -0,0 +1,120 @@
+import copy
+import numpy as np
+
+# Rock detections closer than this to a known sample (in map cells) locate it
+SAMPLE_RADIUS = 3
+
+class MapMetrics(object):
+    """
+    Incremental map quality metrics. The worldmap reports the cells that
+    become or stop being navigable and the cells that receive their first
+    rock detection, so mapped percentage, fidelity and located samples are
+    kept up to date without rescanning the map and the ground truth every
+    frame.
+    """
+
+    def __init__(self, ground_truth, samples_pos=None):
+        # Precomputed boolean index of ground truth navigable cells
+        if ground_truth.ndim == 3:
+            ground_truth = ground_truth[:,:,1]
+        self.ground_truth = ground_truth > 0
+        self.tot_map_pix = int(np.count_nonzero(self.ground_truth))
+        self.tot_nav_pix = 0 # Cells mapped as navigable
+        self.good_nav_pix = 0 # Of those, cells that are navigable in the ground truth
+        self.located = [] # (x, y) of the known samples confirmed by rock detections
+        self.set_samples(samples_pos)
+
+    def __repr__(self):
+        return '{}(mapped={}%, fidelity={}%, located={})'.format(
+            self.__class__.__name__, self.perc_mapped, self.fidelity, self.samples_located)
+
+    def set_samples(self, samples_pos):
+        """
+        Index the known sample positions in a grid hash with SAMPLE_RADIUS
+        buckets. Must be called before rock detections are added.
+        """
+        self.samples_pos = samples_pos
+        self._buckets = {}
+        self._unlocated = set()
+        if samples_pos is None:
+            return
+        for idx, (x, y) in enumerate(zip(samples_pos[0], samples_pos[1])):
+            self._buckets.setdefault((x // SAMPLE_RADIUS, y // SAMPLE_RADIUS), []).append(idx)
+            self._unlocated.add(idx)
+
+    def add_navigable(self, rows, cols):
+        """
+        Count cells that just became navigable. Repeated cells are counted once.
+        """
+        if len(rows) == 0:
+            return
+        size = self.ground_truth.shape[1]
+        linear = np.unique(rows * size + cols)
+        self.tot_nav_pix += len(linear)
+        self.good_nav_pix += int(np.count_nonzero(self.ground_truth.ravel()[linear]))
+
+    def remove_navigable(self, rows, cols):
+        """
+        Uncount cells that are no longer navigable. Repeated cells are
+        uncounted once.
+        """
+        if len(rows) == 0:
+            return
+        size = self.ground_truth.shape[1]
+        linear = np.unique(rows * size + cols)
+        self.tot_nav_pix -= len(linear)
+        self.good_nav_pix -= int(np.count_nonzero(self.ground_truth.ravel()[linear]))
+
+    def add_rocks(self, rows, cols):
+        """
+        Check cells that just received their first rock detection against
+        the samples that have not been located yet.
+        """
+        if not self._unlocated:
+            return
+        for row, col in set(zip(rows.tolist(), cols.tolist())):
+            bucket_x = col // SAMPLE_RADIUS
+            bucket_y = row // SAMPLE_RADIUS
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for idx in self._buckets.get((bucket_x + dx, bucket_y + dy), ()):
+                        if idx not in self._unlocated:
+                            continue
+                        x = self.samples_pos[0][idx]
+                        y = self.samples_pos[1][idx]
+                        if (x - col)**2 + (y - row)**2 < SAMPLE_RADIUS**2:
+                            self._unlocated.discard(idx)
+                            self.located.append((x, y))
+
+    @property
+    def perc_mapped(self):
+        # Percentage of the ground truth map that has been successfully found
+        return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+
+    @property
+    def fidelity(self):
+        # Good map pixel detections divided by total pixels found to be navigable
+        if self.tot_nav_pix > 0:
+            return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+        return 0
+
+    @property
+    def samples_located(self):
+        return len(self.located)
+
+    def summary(self):
+        """
+        Return the current metrics as a dict for logging.
+        """
+        return {'mapped': self.perc_mapped, 'fidelity': self.fidelity,
+                'samples_located': self.samples_located,
+                'nav_pix': self.tot_nav_pix, 'good_nav_pix': self.good_nav_pix}
+
+    def copy(self):
+        """
+        Return a copy that no longer changes with the map.
+        """
+        metrics = copy.copy(self)
+        metrics.located = list(self.located)
+        metrics._unlocated = set(self._unlocated)
+        return metrics
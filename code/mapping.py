@@ -0,0 +1,526 @@
+import numbers
+import numpy as np
+
+# Worldmap channels
+OBSTACLE_CHANNEL = 0
+ROCK_CHANNEL = 1
+NAVIGABLE_CHANNEL = 2
+# A cell is promoted onto the map once more than this many frames saw it
+FILTER_THRESHOLD = 5
+# Navigable cells with more than this many map votes clear any obstacle
+NAV_CONFIRM_THRESHOLD = 15
+# Side length of a map tile in cells
+TILE_SIZE = 64
+# Frames are only counted when pitch and roll are both below this (degrees)
+COUNT_MAX_TILT = 1
+# Log-odds fusion: fixed-point units per unit of log-odds, stored as int8
+LOG_ODDS_SCALE = 16
+# Log-odds added by a full weight navigable or obstacle observation
+NAV_LOG_ODDS = 0.6
+OBS_LOG_ODDS = 0.8
+# Log-odds above which a cell is navigable and below minus which it is an obstacle
+NAV_LOG_ODDS_THRESHOLD = 2.0
+OBS_LOG_ODDS_THRESHOLD = 1.5
+# Pixels up to MAP_NEAR_DIST from the rover get full weight, falling off to
+# zero at MAP_MAX_DIST (warped image pixels, 10 per meter)
+MAP_NEAR_DIST = 40
+MAP_MAX_DIST = 100
+# Frames get full weight up to MAP_FULL_TILT of pitch or roll, falling off
+# to zero at MAP_MAX_TILT (degrees)
+MAP_FULL_TILT = 0.5
+MAP_MAX_TILT = 3.0
+# Fusion names accepted by make_fusion
+MAP_FUSIONS = ('count', 'logodds')
+
+class TiledGrid(object):
+    """
+    Sparse square grid of a compact dtype stored as lazily allocated
+    tiles. Cells of tiles that were never written read as the fill value.
+    All index arrays must already be inside the grid, see inside().
+    """
+
+    def __init__(self, size, dtype, fill=0, tile_size=TILE_SIZE):
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        self.tile_size = tile_size
+        self.tiles_per_side = (size + tile_size - 1) // tile_size
+        self.tiles = {}
+
+    def __repr__(self):
+        return '{}({}, {} tiles)'.format(self.__class__.__name__, self.size, len(self.tiles))
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def inside(self, rows, cols):
+        """
+        Drop the (rows, cols) pairs that fall outside the grid.
+        """
+        valid = (rows >= 0) & (rows < self.size) & (cols >= 0) & (cols < self.size)
+        if valid.all():
+            return rows, cols
+        return rows[valid], cols[valid]
+
+    def _tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = np.full((self.tile_size, self.tile_size), self.fill, dtype=self.dtype)
+            self.tiles[key] = tile
+        return tile
+
+    def _groups(self, rows, cols):
+        # Yield (tile key, selection, tile rows, tile cols) for every tile
+        # touched; a frame usually lands in one or a few tiles
+        keys = (rows // self.tile_size) * self.tiles_per_side + cols // self.tile_size
+        if len(keys) == 0:
+            return
+        first = keys[0]
+        if (keys == first).all():
+            yield first, slice(None), rows % self.tile_size, cols % self.tile_size
+            return
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(sorted_keys)) + 1, [len(keys)]))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            selection = order[start:stop]
+            yield (sorted_keys[start], selection,
+                   rows[selection] % self.tile_size, cols[selection] % self.tile_size)
+
+    def get(self, rows, cols):
+        """
+        Gather the values at (rows, cols).
+        """
+        values = np.full(len(rows), self.fill, dtype=self.dtype)
+        for key, selection, tile_rows, tile_cols in self._groups(rows, cols):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                values[selection] = tile[tile_rows, tile_cols]
+        return values
+
+    def set(self, rows, cols, value):
+        """
+        Set the cells at (rows, cols) to a scalar value.
+        """
+        for key, _, tile_rows, tile_cols in self._groups(rows, cols):
+            self._tile(key)[tile_rows, tile_cols] = value
+
+    def add(self, rows, cols, value=1):
+        """
+        Add value once to every distinct cell at (rows, cols), saturating at
+        the dtype limits, and return the new values in input order. value
+        is a scalar or an array with one value per cell.
+        """
+        result = np.empty(len(rows), dtype=self.dtype)
+        info = np.iinfo(self.dtype)
+        per_cell = isinstance(value, np.ndarray)
+        for key, selection, tile_rows, tile_cols in self._groups(rows, cols):
+            tile = self._tile(key)
+            current = tile[tile_rows, tile_cols]
+            added = value[selection] if per_cell else value
+            updated = np.clip(current.astype(np.int64) + added, info.min, info.max).astype(self.dtype)
+            # Repeated cells carry the same value so the fancy assignment
+            # counts each cell once like the old worldmap += updates
+            tile[tile_rows, tile_cols] = updated
+            result[selection] = updated
+        return result
+
+    def bounds(self):
+        """
+        Return the (row_start, row_stop, col_start, col_stop) box of the
+        allocated tiles, or None when no tile is allocated.
+        """
+        if not self.tiles:
+            return None
+        keys = np.fromiter(self.tiles.keys(), dtype=np.int64, count=len(self.tiles))
+        tile_rows = keys // self.tiles_per_side
+        tile_cols = keys % self.tiles_per_side
+        return (int(tile_rows.min()) * self.tile_size,
+                min(int(tile_rows.max() + 1) * self.tile_size, self.size),
+                int(tile_cols.min()) * self.tile_size,
+                min(int(tile_cols.max() + 1) * self.tile_size, self.size))
+
+    def window(self, bounds):
+        """
+        Assemble the (row_start, row_stop, col_start, col_stop) box of the
+        grid as a dense array, touching only the tiles that overlap it.
+        """
+        row_start, row_stop, col_start, col_stop = bounds
+        grid = np.full((row_stop - row_start, col_stop - col_start), self.fill, dtype=self.dtype)
+        for key, tile in self.tiles.items():
+            row = (key // self.tiles_per_side) * self.tile_size
+            col = (key % self.tiles_per_side) * self.tile_size
+            top = max(row, row_start)
+            bottom = min(row + self.tile_size, row_stop)
+            left = max(col, col_start)
+            right = min(col + self.tile_size, col_stop)
+            if top < bottom and left < right:
+                grid[top - row_start:bottom - row_start, left - col_start:right - col_start] = \
+                    tile[top - row:bottom - row, left - col:right - col]
+        return grid
+
+    def dense(self):
+        """
+        Assemble the whole grid as a dense array.
+        """
+        return self.window((0, self.size, 0, self.size))
+
+# Define a function to merge (row_start, row_stop, col_start, col_stop)
+# boxes, None being empty
+def union_bounds(*boxes):
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), max(box[1] for box in boxes),
+            min(box[2] for box in boxes), max(box[3] for box in boxes))
+
+class WorldMapFusion(object):
+    """
+    Incremental fusion of per-frame detections into the worldmap.
+
+    Every accepted frame counts each hit cell once per class. A cell whose
+    count passes FILTER_THRESHOLD is promoted and from then on gains one
+    map vote per accepted frame. Rather than adding that vote to every
+    promoted cell on every frame, the frame index of the promotion is
+    stored and the votes are derived from it when the map is read, so
+    an update only touches the cells hit by the current frame.
+    """
+
+    def __init__(self, world_size, tile_size=TILE_SIZE):
+        self.world_size = world_size
+        self.frames = 0 # Number of accepted frames
+        # Per class hit counts (the old worldmap_filter) and promotion frame
+        self.counts = {}
+        self.promoted_at = {}
+        for channel in (OBSTACLE_CHANNEL, NAVIGABLE_CHANNEL):
+            self.counts[channel] = TiledGrid(world_size, np.uint16, 0, tile_size)
+            self.promoted_at[channel] = TiledGrid(world_size, np.int32, -1, tile_size)
+
+    @property
+    def nbytes(self):
+        grids = list(self.counts.values()) + list(self.promoted_at.values())
+        return sum(grid.nbytes for grid in grids)
+
+    def accepts(self, pitch, roll):
+        """
+        Only frames taken with the rover level are counted.
+        """
+        return np.absolute(pitch) < COUNT_MAX_TILT and np.absolute(roll) < COUNT_MAX_TILT
+
+    def _count(self, channel, rows, cols):
+        rows, cols = self.counts[channel].inside(rows, cols)
+        counts = self.counts[channel].add(rows, cols)
+        # Cells hit this frame whose count just passed the threshold
+        promoted = counts == FILTER_THRESHOLD + 1
+        rows = rows[promoted]
+        cols = cols[promoted]
+        self.promoted_at[channel].set(rows, cols, self.frames)
+        return rows, cols
+
+    def update(self, nav_cells, obs_cells, nav_dists=None, obs_dists=None, pitch=0, roll=0):
+        """
+        Fuse one frame given the (rows, cols) world cells of its navigable
+        and obstacle pixels. Cells outside the map are dropped. Returns the
+        (rows, cols) of the cells that just became navigable and of the
+        cells that stopped being navigable, or None when the frame was not
+        accepted. Promoted cells stay navigable, so the second is always
+        empty. The pixel distances are not used.
+        """
+        if not self.accepts(pitch, roll):
+            return None
+        self.frames += 1
+        rows, cols = self._count(NAVIGABLE_CHANNEL, *nav_cells)
+        self._count(OBSTACLE_CHANNEL, *obs_cells)
+        return (rows, cols), (rows[:0], cols[:0])
+
+    def bounds(self):
+        """
+        Return the box of the cells that can hold map votes, or None.
+        """
+        return union_bounds(*(grid.bounds() for grid in self.promoted_at.values()))
+
+    def votes(self, channel, bounds=None):
+        """
+        Return the dense map votes of one channel, of the whole map or of
+        a (row_start, row_stop, col_start, col_stop) box.
+        """
+        grid = self.promoted_at[channel]
+        promoted_at = grid.dense() if bounds is None else grid.window(bounds)
+        return np.where(promoted_at >= 0, self.frames - promoted_at + 1, 0)
+
+    def channel(self, channel, bounds=None):
+        """
+        Return the navigable or obstacle channel as a dense float array,
+        of the whole map or of a box.
+        """
+        navigable = self.votes(NAVIGABLE_CHANNEL, bounds)
+        if channel == NAVIGABLE_CHANNEL:
+            return navigable.astype(np.float64)
+        obstacle = self.votes(OBSTACLE_CHANNEL, bounds)
+        obstacle[navigable > NAV_CONFIRM_THRESHOLD] = 0
+        return obstacle.astype(np.float64)
+
+# Define a function to reduce the (rows, cols) world cells of a frame's
+# pixels to the linear index of every distinct in-map cell, with the
+# distance of its nearest pixel
+def nearest_cells(cells, dists, world_size):
+    rows, cols = cells
+    inside = (rows >= 0) & (rows < world_size) & (cols >= 0) & (cols < world_size)
+    linear = rows[inside] * world_size + cols[inside]
+    dists = dists[inside]
+    order = np.lexsort((dists, linear))
+    linear = linear[order]
+    first = np.ones(len(linear), dtype=bool)
+    first[1:] = linear[1:] != linear[:-1]
+    return linear[first], dists[order][first]
+
+# Define a function to weight map pixels by their distance from the rover
+def distance_weights(dists, near_dist=MAP_NEAR_DIST, max_dist=MAP_MAX_DIST):
+    return np.clip((max_dist - dists) / (max_dist - near_dist), 0, 1)
+
+# Define a function to weight a frame by the tilt of the rover
+def tilt_weight(pitch, roll, full_tilt=MAP_FULL_TILT, max_tilt=MAP_MAX_TILT):
+    # Pitch and roll arrive as 0 to 360 degrees
+    tilt = max(min(pitch % 360, -pitch % 360), min(roll % 360, -roll % 360))
+    return float(np.clip((max_tilt - tilt) / (max_tilt - full_tilt), 0, 1))
+
+class LogOddsFusion(object):
+    """
+    Weighted log-odds fusion of per-frame detections into the worldmap.
+
+    Every cell holds the log-odds of being navigable in fixed point as an
+    int8, LOG_ODDS_SCALE units per unit. A navigable pixel adds and an
+    obstacle pixel subtracts its log-odds scaled by a weight, which falls
+    off with the distance of the pixel from the rover and with the tilt of
+    the rover. Frames with moderate pitch and roll are downweighted
+    instead of dropped and far pixels, whose projection is least accurate,
+    count little or nothing. Each cell takes the weight of its nearest
+    pixel once per frame. A cell is navigable once its log-odds reach
+    NAV_LOG_ODDS_THRESHOLD and an obstacle below -OBS_LOG_ODDS_THRESHOLD.
+    """
+
+    def __init__(self, world_size, tile_size=TILE_SIZE, near_dist=MAP_NEAR_DIST,
+                 max_dist=MAP_MAX_DIST, full_tilt=MAP_FULL_TILT, max_tilt=MAP_MAX_TILT):
+        self.world_size = world_size
+        self.near_dist = near_dist
+        self.max_dist = max_dist
+        self.full_tilt = full_tilt
+        self.max_tilt = max_tilt
+        self.frames = 0 # Number of accepted frames
+        self.log_odds = TiledGrid(world_size, np.int8, 0, tile_size)
+        self.nav_units = int(round(NAV_LOG_ODDS_THRESHOLD * LOG_ODDS_SCALE))
+        self.obs_units = int(round(OBS_LOG_ODDS_THRESHOLD * LOG_ODDS_SCALE))
+
+    @property
+    def nbytes(self):
+        return self.log_odds.nbytes
+
+    def _cell_units(self, cells, dists, weight, log_odds):
+        # Fixed-point update of every distinct in-map cell from its nearest pixel
+        if dists is None or len(dists) != len(cells[0]):
+            raise ValueError('Log-odds fusion needs the distance of every pixel')
+        linear, dists = nearest_cells(cells, dists, self.world_size)
+        weights = distance_weights(dists, self.near_dist, self.max_dist)
+        units = np.rint(weights * (weight * log_odds * LOG_ODDS_SCALE)).astype(np.int64)
+        kept = units != 0
+        linear = linear[kept]
+        return linear // self.world_size, linear % self.world_size, units[kept]
+
+    def update(self, nav_cells, obs_cells, nav_dists=None, obs_dists=None, pitch=0, roll=0):
+        """
+        Fuse one frame given the (rows, cols) world cells of its navigable
+        and obstacle pixels and the distances of those pixels from the
+        rover. Returns the (rows, cols) of the cells that became navigable
+        and of the cells that stopped being navigable, or None when the
+        tilt leaves the frame no weight. Obstacle pixels are fused first,
+        a cell they clear that navigable pixels restore is in both.
+        """
+        weight = tilt_weight(pitch, roll, self.full_tilt, self.max_tilt)
+        if weight <= 0:
+            return None
+        self.frames += 1
+        rows, cols, units = self._cell_units(obs_cells, obs_dists, weight, -OBS_LOG_ODDS)
+        previous = self.log_odds.get(rows, cols)
+        updated = self.log_odds.add(rows, cols, units)
+        # Cells that fall below the navigable threshold
+        cleared = (previous >= self.nav_units) & (updated < self.nav_units)
+        cleared = rows[cleared], cols[cleared]
+        rows, cols, units = self._cell_units(nav_cells, nav_dists, weight, NAV_LOG_ODDS)
+        previous = self.log_odds.get(rows, cols)
+        updated = self.log_odds.add(rows, cols, units)
+        # Cells that reach the navigable threshold
+        reached = (previous < self.nav_units) & (updated >= self.nav_units)
+        return (rows[reached], cols[reached]), cleared
+
+    def bounds(self):
+        """
+        Return the box of the cells that can hold log-odds, or None.
+        """
+        return self.log_odds.bounds()
+
+    def channel(self, channel, bounds=None):
+        """
+        Return the navigable or obstacle channel as a dense float array of
+        log-odds past the thresholds, of the whole map or of a box.
+        """
+        grid = self.log_odds.dense() if bounds is None else self.log_odds.window(bounds)
+        log_odds = grid.astype(np.float64)
+        if channel == NAVIGABLE_CHANNEL:
+            return np.where(log_odds >= self.nav_units, log_odds, 0) / LOG_ODDS_SCALE
+        return np.where(log_odds <= -self.obs_units, -log_odds, 0) / LOG_ODDS_SCALE
+
+# Define a function to create a map fusion by name
+def make_fusion(name='count', world_size=200, tile_size=TILE_SIZE):
+    if name == 'count':
+        return WorldMapFusion(world_size, tile_size)
+    if name == 'logodds':
+        return LogOddsFusion(world_size, tile_size)
+    raise ValueError('Unknown map fusion {}, expected one of {}'.format(name, ', '.join(MAP_FUSIONS)))
+
+class TiledWorldMap(object):
+    """
+    Sparse worldmap made of lazily allocated tiles with compact counters.
+    Reads such as worldmap[:, :, 2] or worldmap[mask, 0] return dense
+    float arrays like the old 200x200x3 array did. On large maps read
+    window() instead, which only assembles the box of the allocated
+    tiles. An optional MapMetrics is
+    told about cells that become or stop being navigable and about new
+    rock detections.
+    """
+
+    def __init__(self, world_size, tile_size=TILE_SIZE, metrics=None, fusion=None):
+        self.world_size = world_size
+        self.metrics = metrics
+        self.shape = (world_size, world_size, 3)
+        self.ndim = 3
+        self.fusion = fusion if fusion is not None else WorldMapFusion(world_size, tile_size)
+        self.rocks = TiledGrid(world_size, np.uint16, 0, tile_size)
+        self.version = 0 # Incremented whenever the map may have changed
+
+    @property
+    def nbytes(self):
+        return self.rocks.nbytes + self.fusion.nbytes
+
+    def fuse(self, nav_cells, obs_cells, nav_dists=None, obs_dists=None, pitch=0, roll=0):
+        """
+        Fuse the navigable and obstacle cells of one frame. The fusion
+        decides from the rover's pitch and roll whether and how much the
+        frame counts. Returns True when the frame was fused.
+        """
+        changed = self.fusion.update(nav_cells, obs_cells, nav_dists, obs_dists, pitch, roll)
+        if changed is None:
+            return False
+        self.version += 1
+        if self.metrics is not None:
+            navigable, cleared = changed
+            # Cleared before added, a cell in both ends up counted once
+            self.metrics.remove_navigable(*cleared)
+            self.metrics.add_navigable(*navigable)
+        return True
+
+    def add_rocks(self, rows, cols, votes=10):
+        """
+        Add rock detection votes once to every distinct cell.
+        """
+        rows, cols = self.rocks.inside(rows, cols)
+        if len(rows) > 0:
+            updated = self.rocks.add(rows, cols, votes)
+            self.version += 1
+            if self.metrics is not None:
+                first = updated == min(votes, np.iinfo(self.rocks.dtype).max)
+                self.metrics.add_rocks(rows[first], cols[first])
+
+    def bounds(self):
+        """
+        Return the (row_start, row_stop, col_start, col_stop) box of the
+        allocated tiles, every nonzero cell lies inside it.
+        """
+        bounds = union_bounds(self.rocks.bounds(), self.fusion.bounds())
+        return bounds if bounds is not None else (0, 0, 0, 0)
+
+    def channel(self, channel, bounds=None):
+        """
+        Return one channel as a dense float array, of the whole map or of
+        a (row_start, row_stop, col_start, col_stop) box.
+        """
+        if channel == ROCK_CHANNEL:
+            rocks = self.rocks.dense() if bounds is None else self.rocks.window(bounds)
+            return rocks.astype(np.float64)
+        return self.fusion.channel(channel, bounds)
+
+    def window(self, bounds=None):
+        """
+        Return the three channels of a box, by default the box of the
+        allocated tiles, as a dense float array together with the box.
+        """
+        if bounds is None:
+            bounds = self.bounds()
+        return np.dstack([self.channel(channel, bounds) for channel in range(3)]), bounds
+
+    def snapshot(self):
+        """
+        Return a MapWindow copy of the allocated box.
+        """
+        return MapWindow(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and isinstance(key[-1], numbers.Integral):
+            return self.channel(key[-1])[key[:-1]]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        worldmap = np.dstack([self.channel(channel) for channel in range(3)])
+        if dtype is not None:
+            worldmap = worldmap.astype(dtype)
+        return worldmap
+
+class MapWindow(object):
+    """
+    Dense copy of the allocated box of a TiledWorldMap, which no longer
+    changes with the map, for rendering on another thread. window() returns
+    the copy, dense reads fill in the cells outside the box with zeros.
+    """
+
+    def __init__(self, worldmap):
+        self.world_size = worldmap.world_size
+        self.shape = worldmap.shape
+        self.ndim = 3
+        self.version = worldmap.version
+        self.data, self.box = worldmap.window()
+
+    def bounds(self):
+        return self.box
+
+    def window(self, bounds=None):
+        if bounds is None:
+            return self.data, self.box
+        row_start, row_stop, col_start, col_stop = bounds
+        return np.asarray(self)[row_start:row_stop, col_start:col_stop], bounds
+
+    def __getitem__(self, key):
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        worldmap = np.zeros(self.shape, dtype=np.float64 if dtype is None else dtype)
+        row_start, row_stop, col_start, col_stop = self.box
+        worldmap[row_start:row_stop, col_start:col_stop] = self.data
+        return worldmap
+
+# Define a function to find the (row_start, row_stop, col_start, col_stop)
+# box of a worldmap that can hold nonzero cells, all of a plain array
+def map_bounds(worldmap):
+    if isinstance(worldmap, np.ndarray):
+        return (0, worldmap.shape[0], 0, worldmap.shape[1])
+    return worldmap.bounds()
+
+# Define a function to read a box of a worldmap as a dense float array,
+# by default the box that can hold nonzero cells. Returns the array and
+# the box.
+def map_window(worldmap, bounds=None):
+    if bounds is None:
+        bounds = map_bounds(worldmap)
+    if isinstance(worldmap, np.ndarray):
+        row_start, row_stop, col_start, col_stop = bounds
+        return worldmap[row_start:row_stop, col_start:col_stop], bounds
+    return worldmap.window(bounds)
@@ -1,6 +1,9 @@
+from collections import OrderedDict
 import numpy as np
 import cv2
 from state import calc_rock_dis
+from rock_tracker import LOCATE_CONFIDENCE
+from mapping import nearest_cells
 
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
@@ -42,14 +45,149 @@ def find_rocks(img, rgb_thresh=(160, 160, 160)):
     # Return the binary image
     return color_select
 
+# Packed pixel labels, one bit per class
+LABEL_NAVIGABLE = 1
+LABEL_OBSTACLE = 2
+LABEL_ROCK = 4
+LABEL_OUTSIDE = 8
+# Bit position of each label, used to turn a label into a 0/1 mask
+LABEL_SHIFT = {LABEL_NAVIGABLE: 0, LABEL_OBSTACLE: 1, LABEL_ROCK: 2, LABEL_OUTSIDE: 3}
+
+class ColorClassifier(object):
+    """
+    Fused color classifier which reads every RGB pixel once and writes a
+    packed label image of navigable and rock bits.
+    All thresholds are per channel, so each channel gets a 256 entry
+    lookup table and a pixel's label is the AND of its three entries.
+    """
+
+    def __init__(self, nav_thresh=(160, 160, 160), rock_thresh=(100, 104, 50)):
+        self.nav_thresh = nav_thresh
+        self.rock_thresh = rock_thresh
+        values = np.arange(256)
+        self.lut = np.zeros((1, 256, 3), dtype=np.uint8)
+        for channel in range(3):
+            # Navigable terrain is brighter than the threshold in all channels
+            self.lut[0, values > nav_thresh[channel], channel] |= LABEL_NAVIGABLE
+        # Rocks are bright in red and green but dark in blue
+        self.lut[0, values > rock_thresh[0], 0] |= LABEL_ROCK
+        self.lut[0, values > rock_thresh[1], 1] |= LABEL_ROCK
+        self.lut[0, values < rock_thresh[2], 2] |= LABEL_ROCK
+        # Scratch buffers keyed on image shape
+        self._looked_up = {}
+
+    def classify(self, img, out=None):
+        """
+        Label the navigable and rock pixels of img. The obstacle and
+        outside-FOV labels of warped pixels are derived from the field of
+        view by PerceptionROI.
+        """
+        looked_up = self._looked_up.get(img.shape)
+        if looked_up is None:
+            looked_up = np.empty(img.shape, dtype=np.uint8)
+            self._looked_up[img.shape] = looked_up
+        cv2.LUT(img, self.lut, dst=looked_up)
+        labels = np.bitwise_and(looked_up[:,:,0], looked_up[:,:,1], out=out)
+        return np.bitwise_and(labels, looked_up[:,:,2], out=labels)
+
+# Default classifier with the thresholds used by perception_step
+_classifier = ColorClassifier()
+
+def classify_pixels(img, out=None):
+    return _classifier.classify(img, out)
+
+# Define a function to extract a 0/1 mask of one class from a label image
+def class_mask(labels, label, out=None):
+    out = np.bitwise_and(labels, label, out=out)
+    return np.right_shift(out, LABEL_SHIFT[label], out=out)
+
+# Precomputed per-shape and per-calibration contexts kept by each cache
+CONTEXT_CACHE_SIZE = 4
+
+class ContextCache(object):
+    """
+    Least recently used cache of precomputed contexts. A run only ever
+    uses one image shape and calibration, so a few entries are enough and
+    sweeping over calibrations does not keep every context alive.
+    """
+
+    def __init__(self, maxsize=CONTEXT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        context = self.entries.get(key)
+        if context is not None:
+            self.entries.move_to_end(key)
+        return context
+
+    def put(self, key, context):
+        self.entries[key] = context
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return context
+
+# Number of angle bins in the navigable terrain histogram
+NAV_ANGLE_BINS = 36
+# Steering bias applied to navigable angles (radians)
+NAV_ANGLE_OFFSET = 0.1
+
+class PolarTable(object):
+    """
+    Static per-pixel rover-centric coordinates for a fixed image shape.
+    Holds x, y, distance, angle and angle bin of every pixel so a frame
+    only needs masked gathers instead of recomputing them.
+    """
+
+    def __init__(self, shape, angle_bins=NAV_ANGLE_BINS):
+        self.shape = tuple(shape[:2])
+        rows, cols = self.shape
+        ypos, xpos = np.mgrid[0:rows, 0:cols]
+        # Rover position is at the center bottom of the image
+        self.x = -(ypos - rows).astype(np.float64)
+        self.y = -(xpos - cols/2).astype(np.float64)
+        self.dist, self.angle = to_polar_coords(self.x, self.y)
+        # Angles lie in [-pi/2, pi/2] for every pixel in front of the rover
+        self.angle_bins = angle_bins
+        self.bin_edges = np.linspace(-np.pi/2, np.pi/2, angle_bins + 1)
+        self.bin_centers = (self.bin_edges[:-1] + self.bin_edges[1:]) / 2
+        self.angle_bin = np.clip(np.digitize(self.angle, self.bin_edges) - 1,
+                                 0, angle_bins - 1).ravel()
+        self.angle_flat = self.angle.ravel()
+
+    def gather(self, binary_img):
+        """
+        Return x, y, distance and angle of the nonzero pixels, in the
+        same order as binary_img.nonzero().
+        """
+        selected = binary_img != 0
+        return self.x[selected], self.y[selected], self.dist[selected], self.angle[selected]
+
+# Define a function to sum pixel counts, angles, distances and distance
+# weighted angles per angle bin
+def angle_histogram(bins, dists, angles, angle_bins=NAV_ANGLE_BINS):
+    counts = np.bincount(bins, minlength=angle_bins).astype(np.float64)
+    angle_sums = np.bincount(bins, weights=angles, minlength=angle_bins)
+    dist_sums = np.bincount(bins, weights=dists, minlength=angle_bins)
+    dist_angle_sums = np.bincount(bins, weights=dists * angles, minlength=angle_bins)
+    return counts, angle_sums, dist_sums, dist_angle_sums
+
+# Polar tables keyed on image shape
+_polar_cache = ContextCache()
+
+def get_polar_table(shape):
+    key = tuple(shape[:2])
+    table = _polar_cache.get(key)
+    if table is None:
+        table = PolarTable(key)
+        _polar_cache.put(key, table)
+    return table
+
 # Define a function to convert from image coords to rover coords
 def rover_coords(binary_img):
-    # Identify nonzero pixels
-    ypos, xpos = binary_img.nonzero()
-    # Calculate pixel positions with reference to the rover position being at the 
-    # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float)
+    # Look up the rover-centric position of the nonzero pixels
+    x_pixel, y_pixel, _, _ = get_polar_table(binary_img.shape).gather(binary_img)
     return x_pixel, y_pixel
 
 
@@ -94,89 +232,518 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Return the result
     return x_pix_world, y_pix_world
 
+# Number of warped image pixels per world map cell
+WORLD_SCALE = 10
+
+# Define a function to build the 2x3 affine matrix of a rover pose
+def pose_matrix(xpos, ypos, yaw):
+    # Convert yaw to radians
+    yaw_rad = yaw * np.pi / 180
+    cos_yaw = np.cos(yaw_rad)
+    sin_yaw = np.sin(yaw_rad)
+    return np.array([[cos_yaw, -sin_yaw, xpos],
+                     [sin_yaw, cos_yaw, ypos]])
+
+class WorldProjector(object):
+    """
+    Batched rover-to-world projection. Projects several pixel classes
+    for one pose in a single fused rotate/translate/clip pass into
+    reusable integer index buffers. With clip turned off, pixels outside
+    the map keep their out of range indices so the map can drop them
+    instead of piling them up on the border.
+    """
+
+    def __init__(self, world_size, scale=WORLD_SCALE, clip=True):
+        self.world_size = world_size
+        self.scale = scale
+        self.clip = clip
+        self._resize(0)
+
+    def _resize(self, capacity):
+        self.capacity = capacity
+        self._x = np.empty(capacity, dtype=np.float64)
+        self._y = np.empty(capacity, dtype=np.float64)
+        self._tmp = np.empty(capacity, dtype=np.float64)
+        self._tmp2 = np.empty(capacity, dtype=np.float64)
+        self._x_world = np.empty(capacity, dtype=np.int_)
+        self._y_world = np.empty(capacity, dtype=np.int_)
+
+    def project(self, pixel_sets, pose):
+        """
+        Project a sequence of (xpix, ypix) rover-centric pixel arrays with
+        the 2x3 pose matrix. Returns one (x_world, y_world) pair per input
+        set, as views into buffers reused by the next call.
+        """
+        total = sum(len(xpix) for xpix, _ in pixel_sets)
+        if total > self.capacity:
+            self._resize(max(total, 2 * self.capacity))
+        x = self._x[:total]
+        y = self._y[:total]
+        tmp = self._tmp[:total]
+        tmp2 = self._tmp2[:total]
+        x_world = self._x_world[:total]
+        y_world = self._y_world[:total]
+        bounds = []
+        start = 0
+        for xpix, ypix in pixel_sets:
+            stop = start + len(xpix)
+            x[start:stop] = xpix
+            y[start:stop] = ypix
+            bounds.append((start, stop))
+            start = stop
+        # Rotate, in the same operation order as rotate_pix
+        np.multiply(y, pose[0, 1], out=tmp)
+        np.multiply(x, pose[1, 0], out=tmp2)
+        np.multiply(x, pose[0, 0], out=x)
+        np.add(x, tmp, out=x)
+        np.multiply(y, pose[1, 1], out=y)
+        np.add(tmp2, y, out=y)
+        # Scale and translate, in the same operation order as translate_pix
+        np.divide(x, self.scale, out=x)
+        np.divide(y, self.scale, out=y)
+        np.add(x, pose[0, 2], out=x)
+        np.add(y, pose[1, 2], out=y)
+        # Truncate and clip onto the map like pix_to_world
+        np.copyto(x_world, x, casting='unsafe')
+        np.copyto(y_world, y, casting='unsafe')
+        if self.clip:
+            np.clip(x_world, 0, self.world_size - 1, out=x_world)
+            np.clip(y_world, 0, self.world_size - 1, out=y_world)
+        return [(x_world[a:b], y_world[a:b]) for a, b in bounds]
+
+# World projectors keyed on world size and scale
+_projector_cache = ContextCache()
+
+def get_world_projector(world_size, scale=WORLD_SCALE, clip=True):
+    key = (world_size, scale, clip)
+    projector = _projector_cache.get(key)
+    if projector is None:
+        projector = WorldProjector(world_size, scale, clip)
+        _projector_cache.put(key, projector)
+    return projector
+
+# Calibration box in source (actual) and destination (desired) coordinates
+# Each 10x10 pixel square of the warped image represents 1 square meter
+CALIBRATION_SOURCE = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+# The destination box will be 2*dst_size on each side
+DST_SIZE = 5
+# Set a bottom offset to account for the fact that the bottom of the image 
+# is not the position of the rover but a bit in front of it
+BOTTOM_OFFSET = 6
+
+# Define a function to build the destination points for a given image shape
+def calibration_destination(shape, dst_size=DST_SIZE, bottom_offset=BOTTOM_OFFSET):
+    return np.float32([[shape[1]/2 - dst_size, shape[0] - bottom_offset],
+                      [shape[1]/2 + dst_size, shape[0] - bottom_offset],
+                      [shape[1]/2 + dst_size, shape[0] - 2*dst_size - bottom_offset], 
+                      [shape[1]/2 - dst_size, shape[0] - 2*dst_size - bottom_offset],
+                      ])
+
+class WarpContext(object):
+    """
+    Precomputed perspective warp for a fixed image shape and calibration.
+    Holds the transform matrix, the cv2.remap tables and the constant
+    field of view mask so a frame only costs a single remap.
+    """
+
+    def __init__(self, shape, src, dst):
+        self.shape = tuple(shape[:2])
+        self.src = np.float32(src)
+        self.dst = np.float32(dst)
+        rows, cols = self.shape
+        self.M = cv2.getPerspectiveTransform(self.src, self.dst)
+        # For every output pixel find the source pixel it samples from
+        Minv = cv2.invert(self.M)[1].astype(np.float32)
+        xs, ys = np.meshgrid(np.arange(cols, dtype=np.float32),
+                             np.arange(rows, dtype=np.float32))
+        w = Minv[2, 0] * xs + Minv[2, 1] * ys + Minv[2, 2]
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            self.map1 = (Minv[0, 0] * xs + Minv[0, 1] * ys + Minv[0, 2]) / w
+            self.map2 = (Minv[1, 0] * xs + Minv[1, 1] * ys + Minv[1, 2]) / w
+        # Pixels on the horizon line map to infinity, send them off the image
+        off_image = ~(np.isfinite(self.map1) & np.isfinite(self.map2))
+        self.map1[off_image] = -1
+        self.map2[off_image] = -1
+        # The mask only depends on the geometry so build it once
+        self.mask = cv2.warpPerspective(np.ones(self.shape, dtype=np.uint8), self.M, (cols, rows))
+        self.mask.flags.writeable = False
+
+    def warp(self, img, out=None):
+        """
+        Warp a single image, optionally into a preallocated buffer.
+        """
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, dst=out)
+
+# Warp contexts keyed on image shape and calibration points
+_warp_cache = ContextCache()
+
+def get_warp_context(shape, src=CALIBRATION_SOURCE, dst=None):
+    if dst is None:
+        dst = calibration_destination(shape)
+    src = np.float32(src)
+    dst = np.float32(dst)
+    key = (tuple(shape[:2]), src.tobytes(), dst.tobytes())
+    context = _warp_cache.get(key)
+    if context is None:
+        context = WarpContext(shape, src, dst)
+        _warp_cache.put(key, context)
+    return context
+
 # Define a function to perform a perspective transform
+# The returned mask is shared between calls and must not be modified
 def perspect_transform(img, src, dst):
-           
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
-    mask = cv2.warpPerspective(np.ones_like(img[:,:,0]), M, (img.shape[1], img.shape[0]))# 
-    return warped, mask
+    context = get_warp_context(img.shape, src, dst)
+    warped = context.warp(img)
+    return warped, context.mask
 
+class PerceptionROI(object):
+    """
+    The pixels of a fixed image shape and calibration that can contribute
+    to perception, derived once from the warp. In the warped view only
+    pixels inside the field of view mask, or sampling the camera image at
+    all, can be anything but an out of view zero. In the camera view only
+    rows below the horizon of the calibrated ground plane can show a rock
+    sample, the rows above are sky. The valid warped pixels are kept as a
+    compact list of flat indices with their remap coordinates, mask values
+    and rover-centric coordinates, so a frame warps, classifies and
+    gathers only those pixels.
+    """
 
-# Apply the above functions in succession and update the Rover state accordingly
-def perception_step(Rover):
-    # Perform perception steps to update Rover()
-    # NOTE: camera image is coming to you in Rover.img
-    img = Rover.img
-    # 1) Define source and destination points for perspective transform
-    dst_size = 5 
-    # Set a bottom offset to account for the fact that the bottom of the image 
-    # is not the position of the rover but a bit in front of it
-    bottom_offset = 6
- 
-    # 1) Define source and destination points for perspective transform
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    destination = np.float32([[img.shape[1]/2 - dst_size, img.shape[0] - bottom_offset],
-                      [img.shape[1]/2 + dst_size, img.shape[0] - bottom_offset],
-                      [img.shape[1]/2 + dst_size, img.shape[0] - 2*dst_size - bottom_offset], 
-                      [img.shape[1]/2 - dst_size, img.shape[0] - 2*dst_size - bottom_offset],
-                      ])
-    # 2) Apply perspective transform
-    warped, mask = perspect_transform(Rover.img, source, destination)
-
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    navigable, obs = color_thresh(warped)
-    obstacles = np.absolute(np.float32(navigable) - 1) * mask
-    rocks = find_rocks(Rover.img, rgb_thresh=(100,104,50))
-
-    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-        # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
-        #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
-        #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
-    Rover.vision_image[:,:,0] = obstacles * 255 # Obstacles
-    Rover.vision_image[:,:,1] = rocks * 255 # rocks
-    Rover.vision_image[:,:,2] = navigable * 255 # Navigable
-
-    # 5) Convert map image pixel values to rover-centric coords
-    xpix, ypix = rover_coords(navigable)
-    x_obs_pix, y_obs_pix = rover_coords(obstacles)
-    x_rock_pix, y_rock_pix = rover_coords(rocks)
-
-    x_pix_world, y_pix_world = pix_to_world(xpix, ypix, Rover.pos[0], Rover.pos[1], Rover.yaw, Rover.worldmap.shape[1], 10)
-    x_obs_pix_world, y_obs_pix_world = pix_to_world(x_obs_pix, y_obs_pix, Rover.pos[0], Rover.pos[1],  Rover.yaw, Rover.worldmap.shape[1], 10)
-    x_rock_pix_world, y_rock_pix_world = pix_to_world(x_rock_pix, y_rock_pix, Rover.pos[0], Rover.pos[1],  Rover.yaw, Rover.worldmap.shape[1], 10)
+    def __init__(self, context, polar):
+        self.shape = context.shape
+        rows, cols = self.shape
+        samples_image = (context.map1 > -1) & (context.map1 < cols) & \
+                        (context.map2 > -1) & (context.map2 < rows)
+        valid = samples_image | (context.mask != 0)
+        self.indices = np.flatnonzero(valid)
+        # Remap tables of the valid pixels packed into rows as wide as the
+        # image, cv2.remap is slow on narrow images. The padding samples
+        # off the image.
+        packed_rows = -(-len(self.indices) // cols)
+        self.map1 = np.full(packed_rows * cols, -1, dtype=np.float32)
+        self.map2 = np.full(packed_rows * cols, -1, dtype=np.float32)
+        self.map1[:len(self.indices)] = context.map1.ravel()[self.indices]
+        self.map2[:len(self.indices)] = context.map2.ravel()[self.indices]
+        self.map1 = self.map1.reshape(packed_rows, cols)
+        self.map2 = self.map2.reshape(packed_rows, cols)
+        self.mask = context.mask.ravel()[self.indices]
+        self.x = polar.x.ravel()[self.indices]
+        self.y = polar.y.ravel()[self.indices]
+        self.dist = polar.dist.ravel()[self.indices]
+        self.angle = polar.angle_flat[self.indices]
+        self.angle_bin = polar.angle_bin[self.indices]
+        self.angle_bins = polar.angle_bins
+        # Vision labels of the pixels that are never valid
+        self.outside = np.full(self.shape, LABEL_OUTSIDE, dtype=np.uint8)
+        self.outside.ravel()[self.indices] = 0
+        # Ground pixels project with the same sign of w as the calibration points
+        M = context.M
+        ys, xs = np.mgrid[0:rows, 0:cols]
+        w = M[2, 0] * xs + M[2, 1] * ys + M[2, 2]
+        ground_sign = np.sign(M[2, 0] * context.src[0, 0] + M[2, 1] * context.src[0, 1] + M[2, 2])
+        ground_rows = np.flatnonzero((np.sign(w) == ground_sign).any(axis=1))
+        self.camera_row_start = int(ground_rows[0]) if len(ground_rows) else rows
+        self.camera_x = polar.x[self.camera_row_start:]
+        self.camera_y = polar.y[self.camera_row_start:]
+        self.camera_dist = polar.dist[self.camera_row_start:]
+        self.camera_angle = polar.angle[self.camera_row_start:]
+
+    def warp(self, img, out=None):
+        """
+        Warp the valid pixels of img into a packed image, whose first N
+        pixels in row-major order are the N valid pixels.
+        """
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, dst=out)
+
+    def classify(self, img):
+        """
+        Return the packed navigable / obstacle / rock / outside-FOV labels
+        of the valid warped pixels of img.
+        """
+        return self._label(classify_pixels(self.warp(img)).ravel()[:len(self.indices)])
+
+    def classify_batch(self, imgs):
+        """
+        Return the labels of the valid warped pixels of a stack of images,
+        one row per image.
+        """
+        packed = np.empty((len(imgs),) + self.map1.shape + (3,), dtype=np.uint8)
+        for img, out in zip(imgs, packed):
+            self.warp(img, out=out)
+        labels = classify_pixels(packed.reshape((-1,) + packed.shape[2:]))
+        return self._label(labels.reshape(len(imgs), -1)[:, :len(self.indices)])
+
+    def _label(self, labels):
+        # Turn the color labels of valid pixels into navigable / obstacle /
+        # rock / outside-FOV labels, in place
+        np.bitwise_and(labels, LABEL_NAVIGABLE | LABEL_ROCK, out=labels)
+        # Obstacles are everything inside the field of view that is not
+        # navigable, the 0/1 mask also drops the rock bit
+        obstacles = np.bitwise_xor(labels, 1)
+        np.bitwise_and(obstacles, self.mask, out=obstacles)
+        np.left_shift(obstacles, LABEL_SHIFT[LABEL_OBSTACLE], out=obstacles)
+        np.bitwise_or(labels, obstacles, out=labels)
+        outside = np.bitwise_xor(self.mask, 1)
+        np.left_shift(outside, LABEL_SHIFT[LABEL_OUTSIDE], out=outside)
+        return np.bitwise_or(labels, outside, out=labels)
+
+    def vision(self, labels):
+        """
+        Scatter the labels of the valid pixels into a full label image, or
+        a stack of label rows into a stack of label images. The warped rock
+        labels are left out, the vision image shows rocks in the camera view.
+        """
+        labels = np.asarray(labels)
+        vision = np.empty(labels.shape[:-1] + self.shape, dtype=np.uint8)
+        vision[...] = self.outside
+        vision.reshape(labels.shape[:-1] + (-1,))[..., self.indices] = \
+            np.bitwise_and(labels, LABEL_NAVIGABLE | LABEL_OBSTACLE | LABEL_OUTSIDE)
+        return vision
+
+    def find_rocks(self, img):
+        """
+        Return the rock labels of the camera rows below the horizon.
+        """
+        return class_mask(classify_pixels(img[self.camera_row_start:]), LABEL_ROCK)
+
+    def find_rocks_batch(self, imgs):
+        """
+        Return the rock labels of the camera rows below the horizon of a
+        stack of images.
+        """
+        rows, cols = self.shape
+        camera = np.ascontiguousarray(imgs[:, self.camera_row_start:])
+        labels = classify_pixels(camera.reshape(-1, cols, 3))
+        return class_mask(labels, LABEL_ROCK).reshape(len(imgs), rows - self.camera_row_start, cols)
+
+# Perception regions of interest keyed on image shape and calibration points
+_roi_cache = ContextCache()
+
+def get_perception_roi(shape, src=CALIBRATION_SOURCE, dst=None):
+    context = get_warp_context(shape, src, dst)
+    key = (context.shape, context.src.tobytes(), context.dst.tobytes())
+    roi = _roi_cache.get(key)
+    if roi is None:
+        roi = PerceptionROI(context, get_polar_table(shape))
+        _roi_cache.put(key, roi)
+    return roi
+
+class PerceptionResult(object):
+    """
+    Everything perception derives from one camera frame and pose, before
+    any of it is fused into the Rover state. Cell arrays may be views into
+    buffers reused by the next frame until compact() is called.
+    """
+
+    def __init__(self, vision, nav_cells, obs_cells, rock_pos, rock_dist, rock_angle,
+                 nav_dists, nav_angles, nav_hist, nav_angle_sums, nav_dist_sums, nav_dist_angle_sums,
+                 obs_dists):
+        self.vision = vision # Packed labels, obstacle/navigable from the warped view, rocks from the camera view
+        self.nav_cells = nav_cells # (rows, cols) world cells of navigable pixels
+        self.obs_cells = obs_cells # (rows, cols) world cells of obstacle pixels
+        self.nav_cell_dists = nav_dists # Rover distance of the pixel behind each entry of nav_cells
+        self.obs_cell_dists = obs_dists # Rover distance of the pixel behind each entry of obs_cells
+        self.rock_pos = rock_pos # (x, y) world positions of warped rock pixels
+        self.rock_dist = rock_dist # Distances of camera rock pixels
+        self.rock_angle = rock_angle # Angles of camera rock pixels
+        self.nav_dists = nav_dists # Distances of navigable terrain pixels
+        self.nav_angles = nav_angles # Angles of navigable terrain pixels
+        self.nav_hist = nav_hist # Navigable terrain pixel counts per angle bin
+        self.nav_angle_sums = nav_angle_sums # Sum of navigable terrain angles per angle bin
+        self.nav_dist_sums = nav_dist_sums # Sum of navigable terrain distances per angle bin
+        self.nav_dist_angle_sums = nav_dist_angle_sums # Sum of distance weighted angles per angle bin
+
+    def compact(self, world_size):
+        """
+        Replace the world cell arrays by owned copies holding each in-map
+        cell once, with the distance of its nearest pixel. Fusion counts a
+        cell once per frame from its nearest pixel and drops cells off the
+        map, so this does not change the fused map but makes the result
+        small enough to send between processes.
+        """
+        def unique_cells(cells, dists):
+            linear, dists = nearest_cells(cells, dists, world_size)
+            return ((linear // world_size).astype(np.int32), (linear % world_size).astype(np.int32)), dists
+        self.nav_cells, self.nav_cell_dists = unique_cells(self.nav_cells, self.nav_cell_dists)
+        self.obs_cells, self.obs_cell_dists = unique_cells(self.obs_cells, self.obs_cell_dists)
+        return self
+
+# Define a function to run the per-pixel perception work on one frame
+def perceive(img, pos, yaw, world_size):
+    # 1) Look up the precomputed region of interest for this image shape
+    # and calibration
+    roi = get_perception_roi(img.shape)
+
+    # 2) Apply perspective transform and 3) classify navigable
+    # terrain/obstacles for the valid warped pixels only, and rock samples
+    # in the camera view below the horizon
+    labels = roi.classify(img)
+    rocks = roi.find_rocks(img)
+    # Keep a single packed label image for the vision display
+    vision = roi.vision(labels)
+    camera_vision = vision[roi.camera_row_start:]
+    np.bitwise_or(camera_vision, np.left_shift(rocks, LABEL_SHIFT[LABEL_ROCK]), out=camera_vision)
+    return perceive_labels(roi, labels, rocks, vision, pos, yaw, world_size)
+
+# Define a function to finish perception of one frame from the labels of
+# its valid warped pixels, its camera rock labels and its vision labels.
+# Rock world positions come from the warped rock labels, the camera rock
+# labels only give the rover-centric rock distances and angles to steer by.
+# Without a projector the world cells are views into buffers shared by
+# every frame.
+def perceive_labels(roi, labels, rocks, vision, pos, yaw, world_size, projector=None):
+    navigable = (labels & LABEL_NAVIGABLE) != 0
+    obstacles = (labels & LABEL_OBSTACLE) != 0
+
+    # 4) Look up the rover-centric coords of the classified pixels
+    xpix = roi.x[navigable]
+    ypix = roi.y[navigable]
+    nav_dists = roi.dist[navigable]
+    nav_angles = roi.angle[navigable]
+    x_obs_pix = roi.x[obstacles]
+    y_obs_pix = roi.y[obstacles]
+    obs_dists = roi.dist[obstacles]
+    rock_selected = (labels & LABEL_ROCK) != 0
+    x_rock_pix = roi.x[rock_selected]
+    y_rock_pix = roi.y[rock_selected]
+    camera_rocks = rocks != 0
+    rock_dist = roi.camera_dist[camera_rocks]
+    rock_angle = roi.camera_angle[camera_rocks]
+    nav_hist, nav_angle_sums, nav_dist_sums, nav_dist_angle_sums = \
+        angle_histogram(roi.angle_bin[navigable], nav_dists, nav_angles, roi.angle_bins)
+
+    # 5) Convert rover-centric pixel values to world coordinates
+    # Pixels that fall off the map are dropped by the map, not clipped
+    if projector is None:
+        projector = get_world_projector(world_size, clip=False)
+    pose = pose_matrix(pos[0], pos[1], yaw)
+    (x_pix_world, y_pix_world), (x_obs_pix_world, y_obs_pix_world), \
+        (x_rock_pix_world, y_rock_pix_world) = projector.project(
+            ((xpix, ypix), (x_obs_pix, y_obs_pix), (x_rock_pix, y_rock_pix)), pose)
+
+    return PerceptionResult(vision, (y_pix_world, x_pix_world), (y_obs_pix_world, x_obs_pix_world),
+                            (x_rock_pix_world.copy(), y_rock_pix_world.copy()), rock_dist, rock_angle,
+                            nav_dists, nav_angles, nav_hist, nav_angle_sums,
+                            nav_dist_sums, nav_dist_angle_sums, obs_dists)
+
+# Define a function to perform a perspective transform on a stack of
+# images, returning the stack of warped images and the shared mask
+def perspect_transform_batch(imgs, src, dst):
+    context = get_warp_context(imgs.shape[1:], src, dst)
+    warped = np.empty_like(imgs)
+    for img, out in zip(imgs, warped):
+        context.warp(img, out=out)
+    return warped, context.mask
+
+# Define a function to threshold a stack of images, the thresholds are per
+# pixel so the stack is thresholded as one tall image
+def color_thresh_batch(imgs, rgb_thresh=(160, 160, 160)):
+    above, below = color_thresh(imgs.reshape((-1,) + imgs.shape[2:]), rgb_thresh)
+    return above.reshape(imgs.shape[:3]), below.reshape(imgs.shape[:3])
+
+# Define a function to find rock pixels in a stack of images
+def find_rocks_batch(imgs, rgb_thresh=(160, 160, 160)):
+    return find_rocks(imgs.reshape((-1,) + imgs.shape[2:]), rgb_thresh).reshape(imgs.shape[:3])
+
+# Define a function to convert a stack of binary images to rover coords,
+# concatenated in frame order with the frame index of every pixel
+def rover_coords_batch(binary_imgs):
+    frame_index, rows, cols = binary_imgs.nonzero()
+    polar = get_polar_table(binary_imgs.shape[1:])
+    return polar.x[rows, cols], polar.y[rows, cols], frame_index
+
+# Define a function to map concatenated rover space pixels of several frames
+# to world space, given (xpos, ypos, yaw) per frame and the frame index of
+# every pixel. Matches pix_to_world on every frame.
+def pix_to_world_batch(xpix, ypix, frame_index, poses, world_size, scale):
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 3)
+    # Per frame like rotate_pix, the trigonometry must see the same scalars
+    cos_yaw = np.array([np.cos(yaw * np.pi / 180) for yaw in poses[:, 2]])[frame_index]
+    sin_yaw = np.array([np.sin(yaw * np.pi / 180) for yaw in poses[:, 2]])[frame_index]
+    xpix_rotated = (xpix * cos_yaw) - (ypix * sin_yaw)
+    ypix_rotated = (xpix * sin_yaw) + (ypix * cos_yaw)
+    xpix_translated = (xpix_rotated / scale) + poses[frame_index, 0]
+    ypix_translated = (ypix_rotated / scale) + poses[frame_index, 1]
+    x_pix_world = np.clip(np.int_(xpix_translated), 0, world_size - 1)
+    y_pix_world = np.clip(np.int_(ypix_translated), 0, world_size - 1)
+    return x_pix_world, y_pix_world
+
+# Define a function to run the per-pixel perception work on a stack of
+# frames with one (xpos, ypos, yaw) pose per frame. Returns one
+# PerceptionResult per frame, equal to what perceive() returns for it. The
+# warp, classification and vision labels run on the whole stack, the
+# gathers and projections per frame where they stay in cache. Every result
+# owns its arrays, with compact set they are compacted as they are made,
+# which saves allocating full size world cell arrays for every frame.
+def perceive_batch(imgs, poses, world_size, compact=False):
+    roi = get_perception_roi(imgs.shape[1:])
+    labels = roi.classify_batch(imgs)
+    rocks = roi.find_rocks_batch(imgs)
+    vision = roi.vision(labels)
+    camera_vision = vision[:, roi.camera_row_start:]
+    np.bitwise_or(camera_vision, np.left_shift(rocks, LABEL_SHIFT[LABEL_ROCK]), out=camera_vision)
+    results = []
+    for frame_labels, frame_rocks, frame_vision, (xpos, ypos, yaw) in zip(labels, rocks, vision, poses):
+        if compact:
+            result = perceive_labels(roi, frame_labels, frame_rocks, frame_vision, (xpos, ypos), yaw, world_size)
+            result.compact(world_size)
+        else:
+            result = perceive_labels(roi, frame_labels, frame_rocks, frame_vision, (xpos, ypos), yaw, world_size,
+                                     WorldProjector(world_size, clip=False))
+        results.append(result)
+    return results
+
+# Define a function to update the Rover state with the result of perceive()
+# Results must be applied in frame order since fusion depends on earlier frames
+def apply_perception(Rover, result):
+    # 6) Update Rover.vision_image (this will be displayed on left side of screen)
+    Rover.vision_image[:,:,0] = class_mask(result.vision, LABEL_OBSTACLE) * 255 # Obstacles
+    Rover.vision_image[:,:,1] = class_mask(result.vision, LABEL_ROCK) * 255 # rocks
+    Rover.vision_image[:,:,2] = class_mask(result.vision, LABEL_NAVIGABLE) * 255 # Navigable
+    Rover.vision_version += 1
 
     # 7) Update Rover worldmap (to be displayed on right side of screen)
-    Rover.worldmap[y_rock_pix_world, x_rock_pix_world, 1] += 10
+    rock_x, rock_y = result.rock_pos
+    Rover.worldmap.add_rocks(rock_y, rock_x, 10)
     if not Rover.located_rock and not Rover.stop_breakout.running and not Rover.cancel_loop.running:
-        if np.absolute(Rover.pitch) < 1 and np.absolute(Rover.roll) < 1: 
-            # 6) Convert rover-centric pixel values to world coordinates
-            Rover.worldmap_filter[y_pix_world, x_pix_world, 2] += 1
-            
-            Rover.worldmap_filter[y_obs_pix_world, x_obs_pix_world, 0] += 1
-            nav_terrain = Rover.worldmap_filter[:,:,2] > 5
-            obs_terrain = Rover.worldmap_filter[:,:,0] > 5
-
-            Rover.worldmap[nav_terrain, 2] += 1
-            Rover.worldmap[obs_terrain, 0] += 1
-
-            nav_terrain = Rover.worldmap[:,:,2] > 15
-            Rover.worldmap[nav_terrain, 0] = 0
-
-    if rocks.any():
-        rock_dist, rock_angle = to_polar_coords(x_rock_pix, y_rock_pix)
-        Rover.rock_angle = np.min(rock_angle)
-        Rover.rock_dist = np.min(rock_dist)
-        Rover.rock_pos = (x_rock_pix_world, y_rock_pix_world)
+        # Only the cells hit by this frame are touched, the navigable and
+        # obstacle channels are derived when the map is read. The map's
+        # fusion gates or weights the frame by the rover's pitch and roll.
+        Rover.worldmap.fuse(result.nav_cells, result.obs_cells, result.nav_cell_dists,
+                            result.obs_cell_dists, Rover.pitch, Rover.roll)
+
+    # Cluster the rock pixels into sample candidates, only an uncollected
+    # candidate seen in this frame and over several frames is approached
+    matched = Rover.rock_tracker.update(rock_x, rock_y)
+    located = [candidate for candidate in matched
+               if not candidate.collected and candidate.confidence >= LOCATE_CONFIDENCE]
+    if located:
+        Rover.rock_target = min(located, key=lambda candidate: candidate.distance(Rover.pos[0], Rover.pos[1]))
         if not Rover.near_sample:
             Rover.located_rock = True
+    elif not Rover.located_rock:
+        Rover.rock_target = None
+    if len(result.rock_dist) > 0:
+        Rover.rock_angle = np.min(result.rock_angle)
+        Rover.rock_dist = np.min(result.rock_dist)
+        Rover.rock_pos = result.rock_pos
     else:
         Rover.rock_angle = None
         Rover.rock_dist = None
-    # 8) Convert rover-centric pixel positions to polar coordinates
-    # Update Rover pixel distances and angles
-        # Rover.nav_dists = rover_centric_pixel_distances
-        # Rover.nav_angles = rover_centric_angles
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(xpix, ypix)
-    Rover.nav_angles -= 0.1
-    return Rover
\ No newline at end of file
+    # 8) Update Rover pixel distances and angles
+    Rover.nav_dists = result.nav_dists
+    Rover.nav_angles = result.nav_angles - NAV_ANGLE_OFFSET
+    Rover.nav_count = len(result.nav_angles)
+    # Compact histogram form of the navigable angles for steering
+    Rover.nav_hist = result.nav_hist
+    Rover.nav_angle_sums = result.nav_angle_sums - NAV_ANGLE_OFFSET * result.nav_hist
+    Rover.nav_dist_sums = result.nav_dist_sums
+    Rover.nav_dist_angle_sums = result.nav_dist_angle_sums - NAV_ANGLE_OFFSET * result.nav_dist_sums
+    return Rover
+
+# Apply the above functions in succession and update the Rover state accordingly
+def perception_step(Rover):
+    # Perform perception steps to update Rover()
+    # NOTE: camera image is coming to you in Rover.img
+    result = perceive(Rover.img, Rover.pos, Rover.yaw, Rover.worldmap.shape[1])
+    return apply_perception(Rover, result)
@@ -0,0 +1,233 @@
+import heapq
+import math
+import time
+import numpy as np
+from mapping import OBSTACLE_CHANNEL, NAVIGABLE_CHANNEL, map_bounds, map_window
+
+# Worldmap cells per side of a planning grid cell
+PLAN_CELL = 4
+# Planning grid cell states
+CELL_UNKNOWN = 0
+CELL_FREE = 1
+CELL_BLOCKED = 2
+# Traversal cost of free and unknown cells, blocked cells are impassable
+FREE_COST = 1.0
+UNKNOWN_COST = 3.0
+# Seconds of planning allowed per frame
+PLAN_BUDGET = 0.002
+# Frames between rebuilds of the planning grid from the worldmap
+REFRESH_FRAMES = 10
+# Frontiers closer than this many planning cells are already in view
+MIN_FRONTIER_DIST = 3
+# Planning cells added to a frontier's distance per earlier visit of the rover
+VISIT_PENALTY = 2.0
+# Planning cells ahead along the path the heading points to
+LOOKAHEAD = 3
+
+# Neighbour offsets of the 8-connected planning grid with their step lengths
+_STEPS = [(-1, -1, math.sqrt(2)), (-1, 0, 1.0), (-1, 1, math.sqrt(2)), (0, -1, 1.0),
+          (0, 1, 1.0), (1, -1, math.sqrt(2)), (1, 0, 1.0), (1, 1, math.sqrt(2))]
+
+# Define a function to downsample the worldmap into planning grid cell states
+def occupancy_grid(worldmap, cell=PLAN_CELL):
+    size = worldmap.shape[0] // cell
+    grid = np.full((size, size), CELL_UNKNOWN, dtype=np.uint8)
+    # Only read the box of the map that can hold mapped cells, widened to
+    # whole planning cells
+    row_start, row_stop, col_start, col_stop = map_bounds(worldmap)
+    row_start, col_start = row_start // cell, col_start // cell
+    row_stop, col_stop = min(-(-row_stop // cell), size), min(-(-col_stop // cell), size)
+    if row_start >= row_stop or col_start >= col_stop:
+        return grid
+    window, _ = map_window(worldmap, (row_start * cell, row_stop * cell, col_start * cell, col_stop * cell))
+    def block_counts(channel):
+        occupied = (window[:, :, channel] > 0).view(np.uint8)
+        return occupied.reshape(row_stop - row_start, cell, col_stop - col_start, cell).sum(
+            axis=(1, 3), dtype=np.int32)
+    navigable = block_counts(NAVIGABLE_CHANNEL)
+    obstacles = block_counts(OBSTACLE_CHANNEL)
+    block = grid[row_start:row_stop, col_start:col_stop]
+    block[navigable > 0] = CELL_FREE
+    block[obstacles > navigable] = CELL_BLOCKED
+    return grid
+
+# Define a function to find the free planning cells next to unknown cells
+def find_frontiers(grid):
+    unknown = np.pad(grid == CELL_UNKNOWN, 1)
+    near_unknown = unknown[:-2, 1:-1] | unknown[2:, 1:-1] | unknown[1:-1, :-2] | unknown[1:-1, 2:]
+    return (grid == CELL_FREE) & near_unknown
+
+class FrontierPlanner(object):
+    """
+    Frontier exploration over a coarse occupancy grid built from the
+    worldmap. The planner picks the nearest frontier, penalising cells the
+    rover has already visited, and searches an A* path to it. The search
+    keeps its open list between frames and only expands nodes until the
+    per-frame budget runs out. The grid is rebuilt at most every
+    refresh_frames frames when the map changed, and no search runs on a
+    frame whose rebuild used up the budget. The path is kept while its
+    cells stay passable and the target stays a frontier. The heading to a
+    point LOOKAHEAD cells along the path is left in Rover.plan_heading for
+    the steering policy.
+    """
+
+    def __init__(self, budget=PLAN_BUDGET, cell=PLAN_CELL, refresh_frames=REFRESH_FRAMES):
+        self.budget = budget
+        self.cell = cell
+        self.refresh_frames = refresh_frames
+        self.grid = None
+        self.costs = None # Flat traversal costs, infinite for blocked cells
+        self.frontiers = None
+        self.visits = None # Frames the rover spent in each planning cell
+        self.map_version = None
+        self.frames_since_refresh = 0
+        self.target = None # (row, col) planning cell of the frontier
+        self.path = None # Planning cells from the start to the target
+        self.search = None # State of the unfinished A* search
+        self.heuristic = None # Cached heuristic to the target, per flat cell
+        self.expansions = 0 # Nodes expanded since the start
+
+    def step(self, rover):
+        """
+        Plan for up to budget seconds and update rover.plan_heading.
+        """
+        deadline = time.perf_counter() + self.budget
+        refreshed = self._refresh(rover.worldmap)
+        start = self._cell(rover.pos)
+        if start is None:
+            rover.plan_heading = None
+            return
+        self.visits[start] += 1
+        # A rebuild of the grid can use up the budget, search on the next frame
+        if not refreshed or time.perf_counter() < deadline:
+            if not self._target_valid(start):
+                self._choose_target(start)
+            if self.target is not None and self.path is None:
+                self._search_path(deadline)
+        rover.plan_target = self.target
+        rover.plan_heading = self._heading(rover, start)
+
+    def _cell(self, pos):
+        if pos is None or not np.all(np.isfinite(pos)):
+            return None
+        row = int(pos[1]) // self.cell
+        col = int(pos[0]) // self.cell
+        size = self.grid.shape[0]
+        if not (0 <= row < size and 0 <= col < size):
+            return None
+        return row, col
+
+    def _refresh(self, worldmap):
+        self.frames_since_refresh += 1
+        version = getattr(worldmap, 'version', None)
+        if self.grid is not None and (self.frames_since_refresh < self.refresh_frames or
+                                      (version is not None and version == self.map_version)):
+            return False
+        self.frames_since_refresh = 0
+        self.map_version = version
+        self.grid = occupancy_grid(worldmap, self.cell)
+        if self.visits is None:
+            self.visits = np.zeros(self.grid.shape, dtype=np.int32)
+        self.frontiers = find_frontiers(self.grid)
+        cost_grid = np.where(self.grid == CELL_FREE, FREE_COST, UNKNOWN_COST)
+        cost_grid[self.grid == CELL_BLOCKED] = math.inf
+        self.costs = cost_grid.ravel().tolist()
+        # Give up a path that now crosses blocked cells, the target is
+        # chosen and searched again
+        if self.path is not None:
+            size = self.grid.shape[1]
+            if any(self.costs[row * size + col] == math.inf for row, col in self.path[1:]):
+                self.target = None
+                self.path = None
+                self.search = None
+        return True
+
+    def _target_valid(self, start):
+        if self.target is None or not self.frontiers[self.target]:
+            return False
+        # Reached, look for the next frontier
+        return max(abs(self.target[0] - start[0]), abs(self.target[1] - start[1])) > 1
+
+    def _choose_target(self, start):
+        self.target = None
+        self.path = None
+        self.search = None
+        rows, cols = np.nonzero(self.frontiers)
+        if len(rows) == 0:
+            return
+        dist = np.hypot(rows - start[0], cols - start[1])
+        cost = dist + VISIT_PENALTY * self.visits[rows, cols]
+        cost[dist < MIN_FRONTIER_DIST] = np.inf
+        best = np.argmin(cost)
+        if not np.isfinite(cost[best]):
+            return
+        self.target = (int(rows[best]), int(cols[best]))
+        # Octile distance to the target, computed once per target
+        size = self.grid.shape[0]
+        grid_rows, grid_cols = np.mgrid[0:size, 0:size]
+        d_rows = np.abs(grid_rows - self.target[0])
+        d_cols = np.abs(grid_cols - self.target[1])
+        heuristic = FREE_COST * (np.maximum(d_rows, d_cols) + (math.sqrt(2) - 1) * np.minimum(d_rows, d_cols))
+        self.heuristic = heuristic.ravel().tolist()
+        start_index = start[0] * size + start[1]
+        self.search = {'open': [(self.heuristic[start_index], 0.0, start_index)],
+                       'g': {start_index: 0.0}, 'parent': {start_index: -1}, 'closed': set()}
+
+    def _search_path(self, deadline):
+        search = self.search
+        size = self.grid.shape[0]
+        goal = self.target[0] * size + self.target[1]
+        heap, g, parent, closed = search['open'], search['g'], search['parent'], search['closed']
+        costs, heuristic = self.costs, self.heuristic
+        expanded = 0
+        while heap:
+            if expanded % 32 == 0 and expanded and time.perf_counter() > deadline:
+                self.expansions += expanded
+                return
+            _, cost, index = heapq.heappop(heap)
+            if index in closed:
+                continue
+            closed.add(index)
+            expanded += 1
+            if index == goal:
+                path = []
+                while index != -1:
+                    path.append(divmod(index, size))
+                    index = parent[index]
+                self.path = path[::-1]
+                self.search = None
+                self.expansions += expanded
+                return
+            row, col = divmod(index, size)
+            for d_row, d_col, length in _STEPS:
+                n_row = row + d_row
+                n_col = col + d_col
+                if not (0 <= n_row < size and 0 <= n_col < size):
+                    continue
+                neighbour = n_row * size + n_col
+                step_cost = costs[neighbour]
+                if step_cost == math.inf or neighbour in closed:
+                    continue
+                new_cost = cost + length * step_cost
+                if new_cost < g.get(neighbour, math.inf):
+                    g[neighbour] = new_cost
+                    parent[neighbour] = index
+                    heapq.heappush(heap, (new_cost + heuristic[neighbour], new_cost, neighbour))
+        # No path, give the target up
+        self.expansions += expanded
+        self.frontiers[self.target] = False
+        self.target = None
+        self.search = None
+
+    def _heading(self, rover, start):
+        if self.path is None:
+            return None
+        # Follow the path from the cell closest to the rover
+        nearest = min(range(len(self.path)), key=lambda idx: max(
+            abs(self.path[idx][0] - start[0]), abs(self.path[idx][1] - start[1])))
+        row, col = self.path[min(nearest + LOOKAHEAD, len(self.path) - 1)]
+        target_x = (col + 0.5) * self.cell
+        target_y = (row + 0.5) * self.cell
+        bearing = math.degrees(math.atan2(target_y - rover.pos[1], target_x - rover.pos[0]))
+        # Relative to the rover's yaw, wrapped to +/- 180 degrees
+        return math.radians((bearing - rover.yaw + 180) % 360 - 180)
@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+from datetime import datetime
+
+# Columns of robot_log.csv, the same layout as test_dataset/robot_log.csv
+LOG_COLUMNS = ('Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+               'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll')
+
+class FrameRecorder(object):
+    """
+    Records camera frames and telemetry on a background writer thread.
+
+    record() only puts the received JPEG bytes and a telemetry row on a
+    bounded queue. The writer thread drains the queue in batches, writes
+    the JPEGs without encoding them again into folder/IMG and appends the
+    rows to folder/robot_log.csv, so a recording can be replayed directly.
+    When the queue is full the frame is dropped, or with block set the
+    caller waits for room; both are counted.
+    """
+
+    def __init__(self, folder, queue_size=256, batch_size=16, block=False):
+        self.folder = folder
+        self.image_folder = os.path.join(folder, 'IMG')
+        self.log_path = os.path.join(folder, 'robot_log.csv')
+        self.batch_size = batch_size
+        self.block = block
+        self.recorded = 0 # Frames written to disk
+        self.dropped = 0 # Frames dropped because the queue was full
+        self.waited = 0 # Frames that had to wait for room in the queue
+        self.max_depth = 0 # Deepest the queue has been
+        self.errors = 0 # Frames the writer failed to write
+        self.frames = 0 # Frames passed to record(), numbers the image names
+        if not os.path.exists(self.image_folder):
+            os.makedirs(self.image_folder)
+        write_header = not os.path.isfile(self.log_path)
+        self.log_file = open(self.log_path, 'a')
+        if write_header:
+            self.log_file.write(';'.join(LOG_COLUMNS) + '\n')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name='FrameRecorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, jpeg, Rover, timestamp=None):
+        """
+        Queue one frame. Returns False if it was dropped.
+        """
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        # Timestamps only have millisecond resolution, the frame number
+        # keeps frames recorded in the same millisecond apart
+        name = 'robocam_{}_{:06d}.jpg'.format(timestamp.strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3], self.frames)
+        self.frames += 1
+        path = os.path.join(self.image_folder, name)
+        row = (path, Rover.steer, Rover.throttle, Rover.brake, Rover.vel,
+               Rover.pos[0], Rover.pos[1], Rover.pitch, Rover.yaw, Rover.roll)
+        try:
+            self.queue.put_nowait((path, jpeg, row))
+        except queue.Full:
+            if not self.block:
+                self.dropped += 1
+                return False
+            self.waited += 1
+            self.queue.put((path, jpeg, row))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                path, jpeg, row = item
+                try:
+                    with open(path, 'wb') as image_file:
+                        image_file.write(jpeg)
+                except (IOError, OSError):
+                    self.errors += 1
+                    continue
+                rows.append(';'.join(str(value) for value in row))
+            if rows:
+                self.log_file.write('\n'.join(rows) + '\n')
+                self.log_file.flush()
+                self.recorded += len(rows)
+            for _ in batch:
+                self.queue.task_done()
+
+    def stats(self):
+        """
+        Return the recording and backpressure counters.
+        """
+        return {'recorded': self.recorded, 'dropped': self.dropped, 'waited': self.waited,
+                'queued': self.queue.qsize(), 'max_depth': self.max_depth, 'errors': self.errors}
+
+    def close(self):
+        """
+        Write out everything still queued and stop the writer thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.log_file.close()
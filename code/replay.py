@@ -0,0 +1,275 @@
+# Replay a recorded robot_log.csv or frame log through perception and decision without the simulator
+# Example: $ python replay.py ../test_dataset/robot_log.csv --map replay_map.png
+import argparse
+import csv
+import logging
+import os
+import time
+from itertools import islice
+from multiprocessing import Pool
+from datetime import datetime
+import cv2
+import numpy as np
+from perception import perception_step, perceive_batch, apply_perception
+from decision import decision_step
+from frame_log import FrameLog, TELEMETRY_COLUMNS, is_frame_log
+from rover_state import RoverState, configure_rover
+from rover_clock import make_clock, CLOCKS
+from steering import STEERING_POLICIES
+from mapping import MAP_FUSIONS
+from supporting_functions import convert_to_float, create_plotmap, create_map_image
+
+# Stages timed for every replayed frame
+REPLAY_STAGES = ('load', 'perception', 'decision')
+# Frames handed to a worker at a time in parallel replay
+CHUNK_SIZE = 16
+
+# Define a function to read the rows of a robot_log.csv
+def read_log(csv_path):
+    with open(csv_path, newline='') as log_file:
+        for row in csv.DictReader(log_file, delimiter=';'):
+            yield row
+
+# Define a function to find a logged image, the log stores paths relative
+# to the directory the recording was started from
+def resolve_image_path(image_path, csv_path):
+    if os.path.isfile(image_path):
+        return image_path
+    csv_dir = os.path.dirname(os.path.abspath(csv_path))
+    candidate = os.path.join(csv_dir, image_path)
+    if os.path.isfile(candidate):
+        return candidate
+    return os.path.join(csv_dir, 'IMG', os.path.basename(image_path.replace('\\', '/')))
+
+# Define a function to recover the capture time from an image file name
+# such as robocam_2017_05_02_11_16_21_421.jpg, or with the frame number
+# FrameRecorder appends, robocam_2017_05_02_11_16_21_421_000012.jpg
+def image_timestamp(image_path):
+    name = os.path.splitext(os.path.basename(image_path.replace('\\', '/')))[0]
+    stamp = '_'.join(name.split('_')[1:8])
+    try:
+        return datetime.strptime(stamp, '%Y_%m_%d_%H_%M_%S_%f').timestamp()
+    except ValueError:
+        return None
+
+# Define a function to read an image as RGB like the telemetry images
+def read_image(image_path):
+    image = cv2.imread(image_path)
+    if image is None:
+        raise IOError('Could not read image {}'.format(image_path))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+# Define a function to convert the telemetry columns of a csv row to floats
+def parse_row(row):
+    return dict((name, convert_to_float(row[name])) for name in TELEMETRY_COLUMNS)
+
+# Define a function to iterate over the frames of a recording, either a
+# robot_log.csv or a frame log, as (telemetry, image, timestamp) with float
+# telemetry. Frame log images are read-only views of the memory mapped file.
+# With images False only telemetry and timestamps are read.
+def read_frames(log_path, start=0, stop=None, images=True):
+    if is_frame_log(log_path):
+        log = FrameLog(log_path)
+        stop = len(log) if stop is None else min(stop, len(log))
+        for idx in range(start, stop):
+            timestamp = float(log.timestamps[idx])
+            yield (log.telemetry_dict(idx), log.frames[idx] if images else None,
+                   timestamp if np.isfinite(timestamp) else None)
+        return
+    for row in islice(read_log(log_path), start, stop):
+        image_path = resolve_image_path(row['Path'], log_path)
+        yield (parse_row(row), read_image(image_path) if images else None,
+               image_timestamp(image_path))
+
+# Define a function to count the frames of a recording
+def count_frames(log_path):
+    if is_frame_log(log_path):
+        return len(FrameLog(log_path))
+    return sum(1 for _ in read_log(log_path))
+
+# Define a function to load one logged frame into the Rover the way update_rover does
+def load_frame(Rover, telemetry, image, timestamp):
+    Rover.clock.frame(timestamp)
+    if Rover.start_time is None:
+        Rover.start_time = Rover.clock.now()
+        Rover.total_time = 0
+    else:
+        Rover.total_time = Rover.clock.now() - Rover.start_time
+    Rover.vel = telemetry['Speed']
+    Rover.prev_pos = Rover.pos
+    Rover.pos = [telemetry['X_Position'], telemetry['Y_Position']]
+    if Rover.prev_pos is None:
+        Rover.prev_pos = Rover.pos
+    Rover.yaw = telemetry['Yaw']
+    Rover.pitch = telemetry['Pitch']
+    Rover.roll = telemetry['Roll']
+    Rover.throttle = telemetry['Throttle']
+    Rover.steer = telemetry['SteerAngle']
+    Rover.img = image
+    return Rover
+
+# Define a function to stop any timers the decision step left running
+def stop_timers(Rover):
+    Rover.cancel_search.stop()
+    Rover.stop_breakout.stop()
+    Rover.cancel_loop.stop()
+
+# Define a function to replay a log and return the final Rover and per-frame
+# stage timings in seconds, one row per frame in REPLAY_STAGES order. The
+# decisions follow the logged timestamps by default, or a fixed step per
+# frame with the stepped clock
+def replay(log_path, decide=True, limit=None, clock='logged', step=1/30, steering='mean',
+           mapping='count'):
+    Rover = configure_rover(RoverState(make_clock(clock, step)), steering, mapping)
+    timings = []
+    frames = read_frames(log_path, stop=limit)
+    try:
+        while True:
+            frame_start = time.perf_counter()
+            try:
+                telemetry, image, timestamp = next(frames)
+            except StopIteration:
+                break
+            load_frame(Rover, telemetry, image, timestamp)
+            Rover.timers.tick(Rover.total_time)
+            perception_start = time.perf_counter()
+            if np.isfinite(Rover.vel):
+                perception_step(Rover)
+                decision_start = time.perf_counter()
+                if decide:
+                    decision_step(Rover)
+            else:
+                decision_start = time.perf_counter()
+            frame_end = time.perf_counter()
+            timings.append((perception_start - frame_start,
+                            decision_start - perception_start,
+                            frame_end - decision_start))
+    finally:
+        stop_timers(Rover)
+    return Rover, np.array(timings).reshape(-1, len(REPLAY_STAGES))
+
+# Define a function to run the per-pixel perception of a chunk of logged
+# frames in a worker process, as one batch
+def perceive_chunk(task):
+    log_path, start, stop, world_size = task
+    images = []
+    poses = []
+    load_times = []
+    frames = read_frames(log_path, start, stop)
+    while True:
+        frame_start = time.perf_counter()
+        try:
+            telemetry, image, _ = next(frames)
+        except StopIteration:
+            break
+        images.append(image)
+        poses.append((telemetry['X_Position'], telemetry['Y_Position'], telemetry['Yaw']))
+        load_times.append(time.perf_counter() - frame_start)
+    if not images:
+        return []
+    perception_start = time.perf_counter()
+    results = perceive_batch(np.stack(images), poses, world_size, compact=True)
+    perceive_time = (time.perf_counter() - perception_start) / len(results)
+    return [(result, load_time, perceive_time) for result, load_time in zip(results, load_times)]
+
+# Define a function to replay a log with perception spread over worker
+# processes. The per-pixel work of every frame runs in parallel and the
+# results are fused into the map in frame order, since promotion onto the
+# map and the mapping gates depend on earlier frames, so the result is
+# identical to replay()
+def parallel_replay(log_path, workers=None, decide=True, limit=None, clock='logged', step=1/30,
+                    steering='mean', mapping='count'):
+    Rover = configure_rover(RoverState(make_clock(clock, step)), steering, mapping)
+    count = count_frames(log_path)
+    if limit is not None:
+        count = min(count, limit)
+    world_size = Rover.worldmap.shape[1]
+    tasks = [(log_path, start, min(start + CHUNK_SIZE, count), world_size)
+             for start in range(0, count, CHUNK_SIZE)]
+    frames = read_frames(log_path, stop=count, images=False)
+    timings = []
+    try:
+        with Pool(workers) as pool:
+            for results in pool.imap(perceive_chunk, tasks):
+                for result, load_time, perceive_time in results:
+                    frame_start = time.perf_counter()
+                    telemetry, _, timestamp = next(frames)
+                    load_frame(Rover, telemetry, None, timestamp)
+                    Rover.timers.tick(Rover.total_time)
+                    if np.isfinite(Rover.vel):
+                        apply_perception(Rover, result)
+                        decision_start = time.perf_counter()
+                        if decide:
+                            decision_step(Rover)
+                    else:
+                        decision_start = time.perf_counter()
+                    frame_end = time.perf_counter()
+                    timings.append((load_time,
+                                    perceive_time + decision_start - frame_start,
+                                    frame_end - decision_start))
+    finally:
+        stop_timers(Rover)
+    return Rover, np.array(timings).reshape(-1, len(REPLAY_STAGES))
+
+# Define a function to summarise the replay result. Throughput is taken
+# from the wall time of the run when given, the per-frame perception
+# times of a parallel replay overlap and do not add up to it.
+def replay_report(Rover, timings, wall_time=None):
+    metrics = Rover.map_metrics
+    lines = ['Frames: {}'.format(len(timings)),
+             'Mapped: {}%'.format(metrics.perc_mapped),
+             'Fidelity: {}%'.format(metrics.fidelity)]
+    for stage, column in zip(REPLAY_STAGES, timings.T):
+        if len(column):
+            lines.append('{:<11} median {:7.2f} ms  max {:7.2f} ms  total {:7.2f} s'.format(
+                stage, 1000 * np.median(column), 1000 * np.max(column), np.sum(column)))
+    total = np.sum(timings) if wall_time is None else wall_time
+    if wall_time is not None:
+        lines.append('Wall time: {:.2f} s'.format(wall_time))
+    if total > 0:
+        lines.append('Throughput: {:.1f} frames/s'.format(len(timings) / total))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline replay of a recorded drive')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv or frame log of the recording.'
+    )
+    parser.add_argument('--map', type=str, default='', help='Save the final world map image to this path.')
+    parser.add_argument('--timings', type=str, default='', help='Save per-frame stage timings (ms) to this csv path.')
+    parser.add_argument('--limit', type=int, default=None, help='Only replay the first N frames.')
+    parser.add_argument('--no-decision', action='store_true', help='Skip decision_step.')
+    parser.add_argument('--workers', type=int, default=1, help='Run perception in this many processes (0 for one per core).')
+    parser.add_argument('--clock', type=str, default='logged', choices=CLOCKS,
+                        help='Time source of the decisions: logged timestamps, a fixed step per frame or wall time.')
+    parser.add_argument('--step', type=float, default=1/30, help='Seconds per frame of the stepped clock.')
+    parser.add_argument('--steering', type=str, default='mean', choices=STEERING_POLICIES,
+                        help='Steering policy used when driving forward.')
+    parser.add_argument('--mapping', type=str, default='count', choices=MAP_FUSIONS,
+                        help='Map fusion: frame counts of level frames or distance and tilt weighted log-odds.')
+    parser.add_argument('--verbose', action='store_true', help='Log state transitions and timer events.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(name)s %(message)s')
+
+    run_start = time.perf_counter()
+    if args.workers == 1:
+        Rover, timings = replay(args.log, decide=not args.no_decision, limit=args.limit,
+                                clock=args.clock, step=args.step, steering=args.steering,
+                                mapping=args.mapping)
+    else:
+        Rover, timings = parallel_replay(args.log, workers=args.workers or None,
+                                         decide=not args.no_decision, limit=args.limit,
+                                         clock=args.clock, step=args.step, steering=args.steering,
+                                         mapping=args.mapping)
+    print(replay_report(Rover, timings, time.perf_counter() - run_start))
+    if args.map != '':
+        map_add = create_map_image(Rover, create_plotmap(Rover), Rover.map_metrics.located)
+        cv2.imwrite(args.map, cv2.cvtColor(map_add.clip(0, 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
+    if args.timings != '':
+        np.savetxt(args.timings, 1000 * timings, fmt='%.3f', delimiter=';',
+                   header=';'.join(REPLAY_STAGES), comments='')
@@ -0,0 +1,165 @@
+import math
+import numpy as np
+
+# Detections closer than this (in meters, one map cell each) are the same sample
+ROCK_RADIUS = 3.0
+# Frames of sighting that give a candidate a confidence of 1 - 1/e
+CONFIDENCE_FRAMES = 2.0
+# Confidence a candidate needs before the rover goes to collect it
+LOCATE_CONFIDENCE = 0.5
+
+class RockCandidate(object):
+    """
+    A rock sample candidate in world coordinates, the pixel weighted mean
+    of every detection assigned to it.
+    """
+
+    def __init__(self, x, y, pixels, frame):
+        self.x = x
+        self.y = y
+        self.pixels = pixels # Rock pixels seen over all detections
+        self.frames = 1 # Frames the candidate was detected in
+        self.last_frame = frame
+        self.collected = False
+
+    def __repr__(self):
+        return '{}({:.1f}, {:.1f}, confidence={:.2f})'.format(
+            self.__class__.__name__, self.x, self.y, self.confidence)
+
+    @property
+    def confidence(self):
+        return 1 - math.exp(-self.frames / CONFIDENCE_FRAMES)
+
+    def distance(self, x, y):
+        return math.hypot(self.x - x, self.y - y)
+
+class RockTracker(object):
+    """
+    Clusters the world positions of rock pixels into sample candidates.
+    Every frame the rock pixels are reduced to one detection per
+    ROCK_RADIUS grid cell, and each detection is merged into the closest
+    candidate within ROCK_RADIUS or starts a new one. Candidates are kept
+    in a grid hash with ROCK_RADIUS buckets, so matching a detection looks
+    at the 3x3 buckets around it and the nearest candidate search only
+    visits buckets in rings around the query until no closer one can
+    exist. The rings stop at the bucket extent of all candidates, so a
+    search costs a few rings when a candidate is close and at most one
+    visit per bucket in that extent, independent of the candidate count.
+    """
+
+    def __init__(self, radius=ROCK_RADIUS):
+        self.radius = radius
+        self.candidates = []
+        self.buckets = {} # (bucket x, bucket y) -> candidates
+        self.extent = None # [min x, max x, min y, max y] of the buckets ever used
+        self.frame = 0
+
+    def _bucket(self, x, y):
+        return int(math.floor(x / self.radius)), int(math.floor(y / self.radius))
+
+    def _insert(self, candidate, bucket):
+        self.buckets.setdefault(bucket, []).append(candidate)
+        bucket_x, bucket_y = bucket
+        if self.extent is None:
+            self.extent = [bucket_x, bucket_x, bucket_y, bucket_y]
+        else:
+            extent = self.extent
+            extent[0] = min(extent[0], bucket_x)
+            extent[1] = max(extent[1], bucket_x)
+            extent[2] = min(extent[2], bucket_y)
+            extent[3] = max(extent[3], bucket_y)
+
+    def update(self, rock_x, rock_y):
+        """
+        Add the world positions of the rock pixels of one frame and return
+        the candidates they were assigned to.
+        """
+        self.frame += 1
+        finite = np.isfinite(rock_x) & np.isfinite(rock_y)
+        if not finite.all():
+            rock_x = rock_x[finite]
+            rock_y = rock_y[finite]
+        if len(rock_x) == 0:
+            return []
+        cells = np.floor(rock_x / self.radius) * 1e6 + np.floor(rock_y / self.radius)
+        _, inverse, pixels = np.unique(cells, return_inverse=True, return_counts=True)
+        sum_x = np.bincount(inverse, weights=rock_x)
+        sum_y = np.bincount(inverse, weights=rock_y)
+        seen = set()
+        matched = []
+        for x, y, count in zip((sum_x / pixels).tolist(), (sum_y / pixels).tolist(), pixels.tolist()):
+            candidate = self._match(x, y)
+            if candidate is None:
+                candidate = RockCandidate(x, y, count, self.frame)
+                self.candidates.append(candidate)
+                self._insert(candidate, self._bucket(x, y))
+                seen.add(id(candidate))
+                matched.append(candidate)
+                continue
+            old_bucket = self._bucket(candidate.x, candidate.y)
+            total = candidate.pixels + count
+            candidate.x += (x - candidate.x) * count / total
+            candidate.y += (y - candidate.y) * count / total
+            candidate.pixels = total
+            if id(candidate) not in seen:
+                seen.add(id(candidate))
+                matched.append(candidate)
+                candidate.frames += 1
+            candidate.last_frame = self.frame
+            new_bucket = self._bucket(candidate.x, candidate.y)
+            if new_bucket != old_bucket:
+                self.buckets[old_bucket].remove(candidate)
+                self._insert(candidate, new_bucket)
+        return matched
+
+    def _match(self, x, y):
+        bucket_x, bucket_y = self._bucket(x, y)
+        best = None
+        best_dist = self.radius
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for candidate in self.buckets.get((bucket_x + dx, bucket_y + dy), ()):
+                    dist = candidate.distance(x, y)
+                    if dist < best_dist:
+                        best = candidate
+                        best_dist = dist
+        return best
+
+    def nearest(self, x, y, min_confidence=0.0):
+        """
+        Return the nearest uncollected candidate with at least
+        min_confidence, or None.
+        """
+        if not self.candidates:
+            return None
+        bucket_x, bucket_y = self._bucket(x, y)
+        # No candidate lies beyond the ring that covers the bucket extent
+        min_x, max_x, min_y, max_y = self.extent
+        max_ring = max(abs(min_x - bucket_x), abs(max_x - bucket_x),
+                       abs(min_y - bucket_y), abs(max_y - bucket_y))
+        best = None
+        best_dist = math.inf
+        for ring in range(max_ring + 1):
+            # Candidates in this ring are at least (ring - 1) buckets away
+            if best is not None and (ring - 1) * self.radius > best_dist:
+                break
+            for bx in range(bucket_x - ring, bucket_x + ring + 1):
+                step = 1 if abs(bx - bucket_x) == ring else 2 * ring
+                for by in range(bucket_y - ring, bucket_y + ring + 1, max(step, 1)):
+                    for candidate in self.buckets.get((bx, by), ()):
+                        if candidate.collected or candidate.confidence < min_confidence:
+                            continue
+                        dist = candidate.distance(x, y)
+                        if dist < best_dist:
+                            best = candidate
+                            best_dist = dist
+        return best
+
+    def mark_collected(self, x, y):
+        """
+        Mark the nearest uncollected candidate to (x, y) as collected.
+        """
+        candidate = self.nearest(x, y)
+        if candidate is not None and candidate.distance(x, y) < self.radius:
+            candidate.collected = True
+        return candidate
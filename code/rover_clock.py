@@ -0,0 +1,72 @@
+import time
+
+class Clock(object):
+    """
+    Define a clock object which the state machine, the rover timers and
+    update_rover read the time from. frame() is called once for every
+    telemetry frame, with its logged timestamp when there is one, and
+    now() returns the time in seconds for the current frame.
+    """
+
+    def frame(self, timestamp=None):
+        pass
+
+    def now(self):
+        raise NotImplementedError
+
+class WallClock(Clock):
+    """
+    Wall clock time, used when driving the simulator.
+    """
+
+    def now(self):
+        return time.time()
+
+class LoggedClock(Clock):
+    """
+    Time taken from the logged frame timestamps, so a replay makes the
+    same decisions however fast it runs. Frames without a timestamp keep
+    the time of the previous frame.
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def frame(self, timestamp=None):
+        if timestamp is not None:
+            self.time = timestamp
+
+    def now(self):
+        return self.time
+
+class SteppedClock(Clock):
+    """
+    Time advanced by a fixed step on every frame, for recordings without
+    timestamps and for simulated runs.
+    """
+
+    def __init__(self, step=1/30, start=0.0):
+        self.step = step
+        self.time = start
+        self.frames = 0
+
+    def frame(self, timestamp=None):
+        if self.frames > 0:
+            self.time += self.step
+        self.frames += 1
+
+    def now(self):
+        return self.time
+
+# Clock names accepted by make_clock
+CLOCKS = ('wall', 'logged', 'stepped')
+
+# Define a function to create a clock by name
+def make_clock(name='wall', step=1/30):
+    if name == 'wall':
+        return WallClock()
+    if name == 'logged':
+        return LoggedClock()
+    if name == 'stepped':
+        return SteppedClock(step)
+    raise ValueError('Unknown clock {}, expected one of {}'.format(name, ', '.join(CLOCKS)))
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import matplotlib.image as mpimg
+from rover_clock import WallClock
+from rover_timer import TimerScheduler, CancelSearch, StopBreakout, CancelLoop
+from state import StateMachine
+from mapping import TiledWorldMap, make_fusion
+from steering import MeanSteering, get_steering_policy
+from planner import FrontierPlanner
+from map_metrics import MapMetrics
+from rock_tracker import RockTracker
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+ground_truth = mpimg.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'calibration_images', 'map_bw.png'))
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float64)
+
+# Define RoverState() class to retain rover state parameters
+class RoverState():
+    def __init__(self, clock=None):
+        # Time source of the state machine, timers and total_time
+        self.clock = clock if clock is not None else WallClock()
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.prev_pos = None
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.nav_hist = None # Navigable terrain pixel counts per angle bin
+        self.nav_angle_sums = None # Sum of navigable terrain angles per angle bin
+        self.nav_dist_sums = None # Sum of navigable terrain distances per angle bin
+        self.nav_dist_angle_sums = None # Sum of distance weighted angles per angle bin
+        self.nav_count = 0 # Number of navigable terrain pixels
+        self.steering = MeanSteering() # Steering policy used when driving forward
+        self.planner = None # Optional exploration planner run every decision step
+        self.plan_heading = None # Planner target heading relative to the yaw (radians)
+        self.plan_target = None # Planner target cell
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        # Current mode (can be forward or stop), set by the state machine
+        self.mode = None
+        self.states = StateMachine(self)
+        self.throttle_set = 0.2 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = 50 # Threshold to initiate stopping
+        self.go_forward = 200 # Threshold to go forward again
+        self.max_vel = 1.5 # Maximum velocity (meters/second)
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float64) 
+        self.vision_version = 0 # Incremented whenever vision_image is updated
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        # Mapped percentage, fidelity and located samples, kept up to date
+        # by the worldmap as cells change
+        self.map_metrics = MapMetrics(ground_truth_3d)
+        # Tiles are allocated as the rover explores and cells outside the
+        # map are dropped rather than clipped onto its border
+        self.worldmap = TiledWorldMap(200, metrics=self.map_metrics)
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        self.located_rock = False
+        self.rock_angle = 0
+        self.rock_dist = 0
+        self.rock_pos = 0
+        self.rock_tracker = RockTracker() # Rock sample candidates in world coordinates
+        self.rock_target = None # Confident uncollected candidate matched when the rock was located
+        # Timers run from the main loop on the telemetry clock
+        self.timers = TimerScheduler()
+        self.cancel_search = CancelSearch(self.timers, [self])
+        self.stop_breakout = StopBreakout(self.timers, [self])
+        self.cancel_loop = CancelLoop(self.timers, [self])
+
+# Define a function to set up the steering policy, exploration planner and
+# map fusion of a Rover from their command line names
+def configure_rover(Rover, steering='mean', mapping='count'):
+    Rover.steering = get_steering_policy(steering)
+    if steering == 'frontier':
+        # Explore towards the nearest unmapped frontier
+        Rover.planner = FrontierPlanner()
+    Rover.worldmap.fusion = make_fusion(mapping, Rover.worldmap.world_size)
+    return Rover
@@ -1,33 +1,76 @@
+import heapq
 import numpy as np
-from threading import Timer
 from state import Stop, Breakout, Loop
 
 
 def event_cancel_search(args):
-    args[0].mode = Stop()
+    args[0].states.transition(Stop)
     args[0].located_rock = False
     args[0].cancel_search.stop()
 
 def event_stop_breakout(args):
-    args[0].mode = Breakout()
+    args[0].states.transition(Breakout)
     args[0].stop_breakout.stop()
 
 def event_cancel_loop(args):
-    args[0].mode = Loop()
+    args[0].states.transition(Loop)
     args[0].cancel_loop.stop()
 
-class RoverTimer(Timer):
+class TimerScheduler(object):
+    """
+    Runs the rover timers from the main loop. Deadlines are kept in a heap
+    and tick() is called once per frame with the telemetry clock, so the
+    timer events run on the same thread as perception and decision and a
+    replay fires them at the logged times however fast it runs.
+    """
+
+    def __init__(self):
+        self.now = 0 # Clock value of the latest tick
+        self.heap = [] # (deadline, sequence, timer, generation)
+        self.sequence = 0
+
+    def schedule(self, timer):
+        """
+        Schedule the timer to fire its interval after the latest tick.
+        """
+        # Timers started and stopped every frame leave stale deadlines
+        # behind, drop them before the heap grows
+        if len(self.heap) > 32:
+            self.heap = [entry for entry in self.heap if entry[2].running and entry[2].generation == entry[3]]
+            heapq.heapify(self.heap)
+        self.sequence += 1
+        heapq.heappush(self.heap, (self.now + timer.interval, self.sequence, timer, timer.generation))
+
+    def tick(self, now):
+        """
+        Advance the clock and run the actions of the timers that are due,
+        in deadline order. Stopped or restarted timers are skipped.
+        """
+        if now is None:
+            return
+        self.now = now
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer, generation = heapq.heappop(self.heap)
+            if timer.running and timer.generation == generation:
+                timer.action(*timer.timer_args)
+
+    def clear(self):
+        self.heap = []
+
+class RoverTimer(object):
     """
     Define a timer object which provides some utility functions for the
-    individual events.
+    individual events. The timer is run by a TimerScheduler rather than
+    its own thread.
     """
 
-    def __init__(self, interval, action, *timer_args):
+    def __init__(self, scheduler, interval, action, *timer_args):
         self.running = False
+        self.scheduler = scheduler
         self.interval = interval
         self.action = action
         self.timer_args = timer_args
-        self.timer = None
+        self.generation = 0 # Incremented on stop so stale deadlines are skipped
 
     def __repr__(self):
         """
@@ -47,26 +90,25 @@ class RoverTimer(Timer):
         """
         if not self.running:
             self.running = True
-            self.timer = Timer(self.interval, self.action, args=self.timer_args)
-            self.timer.start()
+            self.scheduler.schedule(self)
 
     def stop(self):
         if self.running:
-            self.timer.cancel()
+            self.generation += 1
             self.running = False
 
 class CancelSearch(RoverTimer):
 
-    def __init__(self, *args):
-        RoverTimer.__init__(self, 90, event_cancel_search, *args)
+    def __init__(self, scheduler, *args):
+        RoverTimer.__init__(self, scheduler, 90, event_cancel_search, *args)
 
 
 class StopBreakout(RoverTimer):
 
-    def __init__(self, *args):
-        RoverTimer.__init__(self, 10, event_stop_breakout, *args)
+    def __init__(self, scheduler, *args):
+        RoverTimer.__init__(self, scheduler, 10, event_stop_breakout, *args)
 
 class CancelLoop(RoverTimer):
 
-    def __init__(self, *args):
-        RoverTimer.__init__(self, 30, event_cancel_loop, *args)
\ No newline at end of file
+    def __init__(self, scheduler, *args):
+        RoverTimer.__init__(self, scheduler, 30, event_cancel_loop, *args)
\ No newline at end of file
@@ -1,5 +1,8 @@
 import numpy as np
-import time
+from event_log import get_logger
+
+# Logs state transitions, rate limited per message
+logger = get_logger('rover.state')
 
 def move_forward(rover):
     # If mode is forward, navigable terrain looks good 
@@ -10,8 +13,14 @@ def move_forward(rover):
     else: # Else coast
         rover.throttle = 0
     rover.brake = 0
-    # Set steering to average angle clipped to the range +/- 15
-    rover.steer = np.clip(np.mean(rover.nav_angles * 180/np.pi), -15, 15)
+    # Steer with the rover's policy on the angle histogram from perception,
+    # clipped to the range +/- 15
+    steer = None
+    if rover.nav_hist is not None:
+        steer = rover.steering.steer(rover)
+    if steer is None:
+        steer = np.clip(np.mean(rover.nav_angles * 180/np.pi), -15, 15)
+    rover.steer = steer
 
 def move_stop(rover):
     rover.throttle = 0
@@ -27,19 +36,20 @@ def move_turnaround(rover):
     rover.steer = -15 # Could be more clever here about which way to turn
 
 def calc_rock_dis(rover):
-    x_min = np.min(rover.rock_pos[0]) - rover.pos[0]
-    y_min = np.min(rover.rock_pos[1]) - rover.pos[1]
-    dist = np.sqrt(x_min * x_min + y_min * y_min)
-    return dist
+    # Distance to the tracked sample, else to the closest rock pixel
+    if rover.rock_target is not None:
+        return rover.rock_target.distance(rover.pos[0], rover.pos[1])
+    return np.min(np.hypot(rover.rock_pos[0] - rover.pos[0], rover.rock_pos[1] - rover.pos[1]))
 
 class State(object):
     """
     Define a state object which provides some utility functions for the
-    individual states within the state machine.
+    individual states within the state machine. Every rover preallocates
+    one instance of each state in its StateMachine and the instance is
+    reset by enter() whenever the state is entered, so transitions do not
+    create objects.
     """
-
-    def __init__(self):
-        print('Processing current state: {}'.format(str(self)))
+    __slots__ = ()
 
     def __repr__(self):
         """
@@ -53,6 +63,12 @@ class State(object):
         """
         return self.__class__.__name__
 
+    def enter(self, rover):
+        """
+        Reset the per-visit fields of this State.
+        """
+        pass
+
     def evaluate(self, rover):
         """
         Handle events that are delegated to this State.
@@ -63,24 +79,26 @@ class Forward(State):
     """
     Processes the forward state class.
     """
+    __slots__ = ()
 
     def evaluate(self, rover):
         """
         Handle events that are delegated to this State.
         """
         # Check the extent of navigable terrain
-        if len(rover.nav_angles) >= rover.stop_forward:  
+        if rover.nav_count >= rover.stop_forward:  
             move_forward(rover)
         # If there's a lack of navigable terrain pixels then go to 'stop' mode
-        elif len(rover.nav_angles) < rover.stop_forward:
+        elif rover.nav_count < rover.stop_forward:
             # Set mode to "stop" and hit the brakes!
             move_stop(rover)
-            rover.mode = Stop()
+            rover.states.transition(Stop)
 
 class Stop(State):
     """
     Processes the stop state class.
     """
+    __slots__ = ()
 
     def evaluate(self, rover):
         """
@@ -92,17 +110,18 @@ class Stop(State):
         # If we're not moving (vel < 0.2) then do something else
         elif rover.vel <= 0.2:
             # Now we're stopped and we have vision data to see if there's a path forward
-            if len(rover.nav_angles) < rover.go_forward:
+            if rover.nav_count < rover.go_forward:
                 move_turnaround(rover)
             # If we're stopped but see sufficient navigable terrain in front then go!
-            if len(rover.nav_angles) >= rover.go_forward:
+            if rover.nav_count >= rover.go_forward:
                 move_forward(rover)
-                rover.mode = Forward()
+                rover.states.transition(Forward)
 
 class Search(State):
     """
     Processes the search state class.
     """
+    __slots__ = ()
 
     def evaluate(self, rover):
         """
@@ -112,15 +131,21 @@ class Search(State):
         if rover.vel > 0.2:
             move_stop(rover)
         else:
-            rover.mode = Collect()
+            rover.states.transition(Collect)
 
 class Collect(State):
     """
     Processes the search state class.
     """
-    no_sight = 0
+    __slots__ = ('no_sight',)
     max_no_sight = 5
 
+    def enter(self, rover):
+        """
+        Forget when the rock was last out of sight.
+        """
+        self.no_sight = 0
+
     def evaluate(self, rover):
         """
         Handle events that are delegated to this State.
@@ -139,15 +164,15 @@ class Collect(State):
                 move_stop(rover)
         else:
             if self.no_sight == 0:
-                self.no_sight = time.time()
-            elif (time.time() - self.no_sight) < self.max_no_sight:
+                self.no_sight = rover.clock.now()
+            elif (rover.clock.now() - self.no_sight) < self.max_no_sight:
                 move_stop(rover)
                 rover.located_rock = False
                 rover.cancel_search.stop()
-                rover.mode = Forward()
+                rover.states.transition(Forward)
 
 class Rotate(State):
-    no_sight = time.time()
+    __slots__ = ()
     max_no_sight = 5
 
     def evaluate(self, rover):
@@ -161,44 +186,96 @@ class Rotate(State):
             # Turn range is +/- 15 degrees, when stopped the next line will induce 4-wheel turning
             _, rover.steer =  (0,-4)# Could be more clever here about which way to turn
         else:
-            rover.mode = Collect()
+            rover.states.transition(Collect)
 
 class Breakout(State):
     """
     Processes the breakout state class.
     """
+    __slots__ = ('turn_tries',)
 
-    def __init__(self):
-        State.__init__(self)
-        self.turn_tries = time.time()
+    def enter(self, rover):
+        """
+        Start the turn from the current clock time.
+        """
+        self.turn_tries = rover.clock.now()
 
     def evaluate(self, rover):
         """
         Handle events that are delegated to this State.
         """
-        if  (time.time() - self.turn_tries) < 5:
+        if  (rover.clock.now() - self.turn_tries) < 5:
             move_turnaround(rover)
-        elif len(rover.nav_angles) >= rover.go_forward:
+        elif rover.nav_count >= rover.go_forward:
             move_forward(rover)
-            rover.mode = Forward()
+            rover.states.transition(Forward)
 
 class Loop(State):
     """
     Processes the loop state class.
     """
+    __slots__ = ('turn_tries',)
+    turn_tries_max = 5
 
-    def __init__(self):
-        State.__init__(self)
-        self.turn_tries = time.time()
-        self.turn_tries_max = 5
+    def enter(self, rover):
+        """
+        Start the turn from the current clock time.
+        """
+        self.turn_tries = rover.clock.now()
 
     def evaluate(self, rover):
         """
         Handle events that are delegated to this State.
         """
-        if (time.time() - self.turn_tries) >= self.turn_tries_max:
-            rover.mode = Forward()
-        elif (time.time() - self.turn_tries) < (self.turn_tries_max / 2):
+        now = rover.clock.now()
+        if (now - self.turn_tries) >= self.turn_tries_max:
+            rover.states.transition(Forward)
+        elif (now - self.turn_tries) < (self.turn_tries_max / 2):
             move_turnaround(rover)
         else:
-            move_forward(rover)
\ No newline at end of file
+            move_forward(rover)
+
+# States that can be entered from any state, by the decision step and the
+# rover timer events
+GLOBAL_TRANSITIONS = (Search, Stop, Breakout, Loop)
+# Allowed transitions, from each state to the states it may enter
+TRANSITIONS = {
+    Stop: (Forward,),
+    Forward: (Stop,),
+    Search: (Collect,),
+    Collect: (Forward,),
+    Rotate: (Collect,),
+    Breakout: (Forward,),
+    Loop: (Forward,),
+}
+for _state in TRANSITIONS:
+    TRANSITIONS[_state] = frozenset(TRANSITIONS[_state] + GLOBAL_TRANSITIONS)
+
+class StateMachine(object):
+    """
+    Define a state machine object which owns one preallocated instance of
+    every state and moves the rover between them along TRANSITIONS. The
+    current state is kept in rover.mode.
+    """
+
+    def __init__(self, rover, initial=Stop):
+        self.rover = rover
+        self.states = dict((state, state()) for state in TRANSITIONS)
+        self.transitions = 0 # Number of transitions made
+        rover.mode = self.states[initial]
+        rover.mode.enter(rover)
+
+    def transition(self, state):
+        """
+        Enter the given State class, resetting it even if it is the
+        current state. Raises ValueError for a transition not in TRANSITIONS.
+        """
+        rover = self.rover
+        current = type(rover.mode)
+        if state not in TRANSITIONS[current]:
+            raise ValueError('No transition from {} to {}'.format(current.__name__, state.__name__))
+        rover.mode = self.states[state]
+        rover.mode.enter(rover)
+        self.transitions += 1
+        logger.info('state_transition from=%s to=%s time=%.2f',
+                    current.__name__, state.__name__, rover.total_time or 0)
\ No newline at end of file
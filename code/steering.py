@@ -0,0 +1,137 @@
+import numpy as np
+
+# Steering range in degrees
+MAX_STEER = 15
+# Names accepted by get_steering_policy
+STEERING_POLICIES = ('mean', 'wall', 'widest', 'frontier')
+
+class SteeringPolicy(object):
+    """
+    Define a steering policy object which picks a steering angle from the
+    navigable terrain angle histogram perception leaves in the Rover:
+    nav_hist (pixel counts), nav_angle_sums, nav_dist_sums and
+    nav_dist_angle_sums per angle bin. Every policy works on the bins
+    only, so a decision costs the same however many pixels are navigable.
+    """
+
+    def angle(self, rover):
+        """
+        Return the steering angle in radians, or None without navigable terrain.
+        """
+        raise NotImplementedError
+
+    def steer(self, rover):
+        """
+        Return the steering angle in degrees clipped to +/- MAX_STEER, or
+        None without navigable terrain.
+        """
+        angle = self.angle(rover)
+        if angle is None:
+            return None
+        return np.clip(angle * 180/np.pi, -MAX_STEER, MAX_STEER)
+
+class MeanSteering(SteeringPolicy):
+    """
+    Steer to the mean angle of the navigable pixels, optionally weighting
+    every pixel by its distance so open terrain further ahead counts more.
+    """
+
+    def __init__(self, distance_weighted=False):
+        self.distance_weighted = distance_weighted
+
+    def angle(self, rover):
+        if self.distance_weighted:
+            total = np.sum(rover.nav_dist_sums)
+            if total <= 0:
+                return None
+            return np.sum(rover.nav_dist_angle_sums) / total
+        total = np.sum(rover.nav_hist)
+        if total <= 0:
+            return None
+        return np.sum(rover.nav_angle_sums) / total
+
+class WallFollowSteering(SteeringPolicy):
+    """
+    Steer off the mean angle towards one side by a multiple of the angle
+    spread, so the rover keeps to the wall on that side. The spread is
+    taken from the per-bin mean angles, which ignores the spread within a
+    bin.
+    """
+
+    def __init__(self, side='left', spread=0.8):
+        self.side = 1 if side == 'left' else -1 # Positive angles are to the left
+        self.spread = spread
+
+    def angle(self, rover):
+        counts = rover.nav_hist
+        total = np.sum(counts)
+        if total <= 0:
+            return None
+        mean = np.sum(rover.nav_angle_sums) / total
+        occupied = counts > 0
+        bin_means = rover.nav_angle_sums[occupied] / counts[occupied]
+        std = np.sqrt(np.sum(counts[occupied] * (bin_means - mean)**2) / total)
+        return mean + self.side * self.spread * std
+
+class WidestGapSteering(SteeringPolicy):
+    """
+    Steer to the middle of the widest run of open angle bins. A bin is
+    open when it holds at least min_pixels navigable pixels whose mean
+    distance is at least min_dist pixels, so a gap must be clear some way
+    ahead. Falls back to the mean angle when no bin is open.
+    """
+
+    def __init__(self, min_pixels=20, min_dist=30):
+        self.min_pixels = min_pixels
+        self.min_dist = min_dist
+
+    def angle(self, rover):
+        counts = rover.nav_hist
+        total = np.sum(counts)
+        if total <= 0:
+            return None
+        mean_dist = rover.nav_dist_sums / np.maximum(counts, 1)
+        open_bins = (counts >= self.min_pixels) & (mean_dist >= self.min_dist)
+        if not open_bins.any():
+            return np.sum(rover.nav_angle_sums) / total
+        # Start and end of every run of open bins
+        edges = np.diff(np.concatenate(([0], open_bins.view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        stops = np.flatnonzero(edges == -1)
+        widest = np.argmax(stops - starts)
+        gap = slice(starts[widest], stops[widest])
+        return np.sum(rover.nav_angle_sums[gap]) / np.sum(counts[gap])
+
+class HeadingSteering(SteeringPolicy):
+    """
+    Steer towards the target heading left in Rover.plan_heading by the
+    planner, through the angle bin with at least min_pixels navigable
+    pixels closest to it. Falls back to the fallback policy without a
+    heading or without such a bin.
+    """
+
+    def __init__(self, min_pixels=20, fallback=None):
+        self.min_pixels = min_pixels
+        self.fallback = fallback if fallback is not None else MeanSteering()
+
+    def angle(self, rover):
+        heading = getattr(rover, 'plan_heading', None)
+        counts = rover.nav_hist
+        open_bins = counts >= self.min_pixels
+        if heading is None or not open_bins.any():
+            return self.fallback.angle(rover)
+        bin_means = rover.nav_angle_sums[open_bins] / counts[open_bins]
+        return bin_means[np.argmin(np.abs(bin_means - heading))]
+
+# Define a function to create a steering policy by name
+def get_steering_policy(name='mean'):
+    if name == 'mean':
+        return MeanSteering()
+    if name == 'wall':
+        return WallFollowSteering()
+    if name == 'widest':
+        return WidestGapSteering()
+    if name == 'frontier':
+        return HeadingSteering()
+    raise ValueError('Unknown steering policy {}, expected one of {}'.format(
+        name, ', '.join(STEERING_POLICIES)))
@@ -4,122 +4,198 @@ from PIL import Image
 from io import BytesIO, StringIO
 import base64
 import time
+from mapping import map_window
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
       if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
+            float_value = float(string_to_convert.replace(',','.'))
       else: 
-            float_value = np.float(string_to_convert)
+            float_value = float(string_to_convert)
       return float_value
 
+# Telemetry fields holding numbers and how many values each one carries,
+# in the order TelemetryParser parses them
+TELEMETRY_SCHEMA = (('speed', 1), ('position', 2), ('yaw', 1), ('pitch', 1), ('roll', 1),
+                    ('throttle', 1), ('steering_angle', 1), ('near_sample', 1),
+                    ('picking_up', 1), ('sample_count', 1))
+
+class TelemetryParser(object):
+      """
+      Parses telemetry with a precompiled field schema. All numeric fields
+      are converted in a single call and the camera frame is decoded into
+      a small pool of preallocated RGB buffers instead of a new image
+      object every frame.
+      """
+
+      def __init__(self, schema=TELEMETRY_SCHEMA, pool_size=2):
+            self.fields = tuple(name for name, _ in schema)
+            # Index of the first value of every field in the parsed array
+            self.index = {}
+            offset = 0
+            for name, count in schema:
+                  self.index[name] = offset
+                  offset += count
+            self.count = offset
+            self.pool_size = pool_size
+            self.pool = []
+            self.next_buffer = 0
+
+      def parse_numbers(self, data):
+            """
+            Return the numeric fields as a flat list of floats.
+            """
+            joined = ';'.join([data[name] for name in self.fields])
+            # Independent of decimal convention, positions are ';' separated
+            values = np.array(joined.replace(',', '.').split(';'), dtype=np.float64)
+            if len(values) != self.count:
+                  raise ValueError('Expected {} telemetry values, got {}'.format(self.count, len(values)))
+            return values.tolist()
+
+      def decode_image(self, image_string):
+            """
+            Decode a base64 JPEG camera frame into a pooled RGB buffer and
+            return the buffer along with the raw JPEG bytes. A buffer is
+            reused pool_size frames later.
+            """
+            jpeg = base64.b64decode(image_string)
+            bgr = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if bgr is None:
+                  raise ValueError('Could not decode telemetry image')
+            slot = self.next_buffer
+            self.next_buffer = (slot + 1) % self.pool_size
+            if slot == len(self.pool):
+                  self.pool.append(np.empty_like(bgr))
+            elif self.pool[slot].shape != bgr.shape:
+                  self.pool[slot] = np.empty_like(bgr)
+            buffer = self.pool[slot]
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=buffer)
+            return buffer, jpeg
+
+# Parser used by update_rover
+_telemetry_parser = TelemetryParser()
+
 def update_rover(Rover, data):
+      values = _telemetry_parser.parse_numbers(data)
+      index = _telemetry_parser.index
+      Rover.clock.frame()
       # Initialize start time and sample positions
       if Rover.start_time == None:
-            Rover.start_time = time.time()
+            Rover.start_time = Rover.clock.now()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
+            samples_xpos = np.int_(np.array(data["samples_x"].replace(',', '.').split(';'), dtype=np.float64))
+            samples_ypos = np.int_(np.array(data["samples_y"].replace(',', '.').split(';'), dtype=np.float64))
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.map_metrics.set_samples(Rover.samples_pos)
+            Rover.samples_to_find = int(values[index["sample_count"]])
       # Or just update elapsed time
       else:
-            tot_time = time.time() - Rover.start_time
+            tot_time = Rover.clock.now() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
-      # Print out the fields in the telemetry data dictionary
-      # print(data.keys())
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
+      Rover.vel = values[index["speed"]]
       # The current position of the rover
       Rover.prev_pos = Rover.pos
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
+      Rover.pos = values[index["position"]:index["position"] + 2]
       if Rover.prev_pos is None:
             Rover.prev_pos = Rover.pos
       # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
-      # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.yaw = values[index["yaw"]]
+      # The current pitch angle of the rover
+      Rover.pitch = values[index["pitch"]]
+      # The current roll angle of the rover
+      Rover.roll = values[index["roll"]]
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = values[index["throttle"]]
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = values[index["steering_angle"]]
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = int(values[index["near_sample"]])
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = int(values[index["picking_up"]])
       # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
+      Rover.samples_collected = Rover.samples_to_find - int(values[index["sample_count"]])
 
-      # print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      # Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      # 'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      # 'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      # 'samples collected:', Rover.samples_collected)
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      Rover.img, image = _telemetry_parser.decode_image(data["image"])
 
-      # Return updated Rover and separate image for optional saving
+      # Return updated Rover and the raw JPEG bytes for optional saving
       return Rover, image
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
+class OutputSnapshot(object):
+      """
+      Copy of the Rover fields create_output_images reads, so the inset
+      images can be rendered on another thread while the Rover changes.
+      """
+
+      def __init__(self, Rover):
+            # Only the allocated box of a tiled map is copied
+            if isinstance(Rover.worldmap, np.ndarray):
+                  self.worldmap = Rover.worldmap.copy()
+            else:
+                  self.worldmap = Rover.worldmap.snapshot()
+            self.ground_truth = Rover.ground_truth
+            self.vision_image = Rover.vision_image.copy()
+            self.samples_pos = Rover.samples_pos
+            self.map_metrics = Rover.map_metrics.copy()
+            self.total_time = Rover.total_time
+            self.samples_collected = Rover.samples_collected
 
+# Define a function to build the scaled obstacle/navigable map used for display
+def create_plotmap(Rover):
+
+      # Only the box of the map that can hold nonzero cells is read
+      worldmap, (row_start, row_stop, col_start, col_stop) = map_window(Rover.worldmap)
       # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-      else:
-            obstacle = Rover.worldmap[:,:,0]
+      navigable = worldmap[:,:,2]
+      nav_pix = navigable > 0
+      if nav_pix.any():
+            navigable = navigable * (255 / np.mean(navigable[nav_pix]))
+      obstacle = worldmap[:,:,0]
+      obs_pix = obstacle > 0
+      if obs_pix.any():
+            obstacle = obstacle * (255 / np.mean(obstacle[obs_pix]))
 
       likely_nav = navigable >= obstacle
       obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
-      # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
+      # The display image covers the whole map, only its box is filled in
+      plotmap = np.zeros(Rover.worldmap.shape, dtype=np.float64)
+      box = plotmap[row_start:row_stop, col_start:col_stop]
+      box[:, :, 0] = obstacle
+      box[:, :, 2] = navigable
+      np.clip(box, 0, 255, out=box)
+      return plotmap
 
+# Define a function to find the known samples confirmed by rock detections
+def locate_samples(Rover):
+      located = []
       # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
+      worldmap, (row_start, _, col_start, _) = map_window(Rover.worldmap)
+      rock_rows, rock_cols = worldmap[:,:,1].nonzero()
+      rock_world_pos = (rock_rows + row_start, rock_cols + col_start)
       # If there are, we'll step through the known sample positions
       # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
-            rock_size = 2
+      if Rover.samples_pos is not None and rock_world_pos[0].any():
             for idx in range(len(Rover.samples_pos[0])):
                   test_rock_x = Rover.samples_pos[0][idx]
                   test_rock_y = Rover.samples_pos[1][idx]
                   rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
                                         (test_rock_y - rock_world_pos[0])**2)
                   # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
+                  # consider it a success
                   if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+                        located.append((test_rock_x, test_rock_y))
+      return located
 
-      # Calculate some statistics on the map results
+# Define a function to calculate mapped percentage and fidelity of the map
+def map_statistics(Rover, plotmap):
       # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
+      tot_nav_pix = float(np.count_nonzero(plotmap[:,:,2]))
       # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
+      good_nav_pix = float(np.count_nonzero((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)))
       # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
+      tot_map_pix = float(np.count_nonzero(Rover.ground_truth[:,:,1]))
       # Calculate the percentage of ground truth map that has been successfully found
       perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
       # Calculate the number of good map pixel detections divided by total pixels 
@@ -128,8 +204,42 @@ def create_output_images(Rover):
             fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
       else:
             fidelity = 0
+      return perc_mapped, fidelity
+
+# Define a function to overlay the plotmap, ground truth and located samples
+def create_map_image(Rover, plotmap, located):
+      # Overlay obstacle and navigable terrain map with ground truth map
+      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
+      # Plot the location of the known samples that were located
+      rock_size = 2
+      for test_rock_x, test_rock_y in located:
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
       # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      return np.flipud(map_add).astype(np.float32)
+
+# Define a function to JPEG encode an image as a base64 string for the server
+def encode_image(image):
+      pil_img = Image.fromarray(image.astype(np.uint8))
+      buff = BytesIO()
+      pil_img.save(buff, format="JPEG")
+      return base64.b64encode(buff.getvalue()).decode("utf-8")
+
+# Define a function to create the map inset given worldmap results
+def create_map_inset(Rover):
+
+      plotmap = create_plotmap(Rover)
+      metrics = getattr(Rover, 'map_metrics', None)
+      if metrics is not None:
+            # Statistics kept up to date as the map changed
+            located = metrics.located
+            perc_mapped, fidelity = metrics.perc_mapped, metrics.fidelity
+      else:
+            located = locate_samples(Rover)
+            # Calculate some statistics on the map results
+            perc_mapped, fidelity = map_statistics(Rover, plotmap)
+      samples_located = len(located)
+      map_add = create_map_image(Rover, plotmap, located)
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -143,18 +253,70 @@ def create_output_images(Rover):
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-      
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+      # Convert map to base64 string for sending to server
+      return encode_image(map_add)
+
+# Define a function to create the vision inset
+def create_vision_inset(Rover):
+      return encode_image(Rover.vision_image)
+
+# Define a function to create display output given worldmap results
+def create_output_images(Rover):
+      return create_map_inset(Rover), create_vision_inset(Rover)
+
+class InsetScheduler(object):
+      """
+      Throttles the inset images to a target display rate. On a due frame
+      an inset is only rendered again when what it shows changed, otherwise
+      and on every other frame the last encoded strings are reused. The map
+      inset is refreshed at least every max_age seconds for its clock.
+      """
 
-      return encoded_string1, encoded_string2
+      def __init__(self, rate=5, max_age=1.0):
+            self.interval = 1.0 / rate if rate > 0 else 0 # Seconds between renders, 0 renders every frame
+            self.max_age = max_age # Refresh the map inset at least this often for the clock
+            self.last_render = None
+            self.map_key = None
+            self.map_time = None
+            self.vision_key = None
+            self.map_string = ''
+            self.vision_string = ''
 
+      def state_key(self, Rover):
+            """
+            Return what the map and vision insets depend on. Without version
+            counters an inset always counts as changed.
+            """
+            map_version = getattr(Rover.worldmap, 'version', None)
+            vision_version = getattr(Rover, 'vision_version', None)
+            if map_version is not None:
+                  map_version = (map_version, Rover.samples_collected)
+            return map_version, vision_version
 
+      def due(self, now):
+            """
+            Check whether the display interval has passed.
+            """
+            return self.last_render is None or now - self.last_render >= self.interval
 
+      def images(self, Rover, now=None, key=None):
+            """
+            Return the inset image strings, rendering the changed insets if
+            a render is due. Pass key when Rover is a snapshot.
+            """
+            if now is None:
+                  now = time.time()
+            if not self.due(now):
+                  return self.map_string, self.vision_string
+            self.last_render = now
+            map_key, vision_key = key if key is not None else self.state_key(Rover)
+            # Without a display rate every frame is rendered, clock included
+            if self.interval == 0 or map_key is None or map_key != self.map_key \
+                  or now - self.map_time >= self.max_age:
+                  self.map_string = create_map_inset(Rover)
+                  self.map_key = map_key
+                  self.map_time = now
+            if vision_key is None or vision_key != self.vision_key:
+                  self.vision_string = create_vision_inset(Rover)
+                  self.vision_key = vision_key
+            return self.map_string, self.vision_string